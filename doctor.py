@@ -11,30 +11,174 @@ try:
     from ZeekControl import cmdresult
     BINARY = "zeek"
 except ImportError:
-    import BroControl.plugin as PluginBase
-    from BroControl import cmdresult
-    BINARY = "bro"
-
-from collections import defaultdict, namedtuple
-from functools import reduce
-from math import sqrt
+    try:
+        import BroControl.plugin as PluginBase
+        from BroControl import cmdresult
+        BINARY = "bro"
+    except ImportError:
+        # Running without broctl, like "python doctor.py bench"
+        PluginBase = cmdresult = None
+        BINARY = "zeek"
+
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import defaultdict, deque, namedtuple
+from heapq import heapify, heappop, heappush, nlargest
+from operator import itemgetter
+from math import ceil, sqrt
+import base64
+import calendar
+import ctypes
+import ctypes.util
+import fnmatch
 import gzip
-import glob
+import hashlib
+import io
 import json
+import mmap
+import multiprocessing
 import os
+import pickle
+import random
+import re
+import resource
+import sqlite3
 import subprocess
 import string
+import struct
 import sys
+import tempfile
 import textwrap
+import threading
+import time
 import traceback
+import zlib
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+# The JSON log reader uses the fastest decoder available
+try:
+    import orjson as fast_json
+except ImportError:
+    try:
+        import ujson as fast_json
+    except ImportError:
+        try:
+            import simdjson as fast_json
+        except ImportError:
+            fast_json = json
+
+# Used for the capture loss and distribution statistics when installed
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Rotated logs compressed with zstd or lz4 are read in process when these
+# are installed, and through the zstd or lz4 programs otherwise
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
 
 lowercase_chars = set(string.ascii_lowercase)
 uppercase_chars = set(string.ascii_uppercase)
         
 GOBACK = 7 # days
 LOSS_THRESHOLD = 1
+# Percentiles of the capture loss reported for each worker
+LOSS_PERCENTILES = (50, 95, 99)
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+REVERSE_BLOCK_SIZE = 64 * 1024
+LOG_EXTENSIONS = (".log", ".gz", ".zst", ".lz4")
+# Programs that can decompress each kind of rotated log, best first
+DECOMPRESS_COMMANDS = {".gz": ("pigz", "gzip"), ".zst": ("zstd",), ".lz4": ("lz4",)}
+# Size of the reads from compressed logs and of their read buffer
+DECOMPRESS_BLOCK = 1024 * 1024
+SKETCH_HASHES = 4
+# How long before a log's rotation its records may start
+WINDOW_SLACK = 3600
+PROBE_CACHE_DAYS = 30
+LISTING_CACHE_DAYS = 30
+PROBE_MARK = "==doctor-probe=="
+# check_worker_load: time between the two samples of each host, the CPU use
+# of a worker that can't keep up, and the line before each sample
+LOAD_SAMPLE_SECONDS = 3
+LOAD_CPU_PEGGED = 95
+LOAD_MARK = "==doctor-load=="
+# ethtool -S counters of packets the NIC dropped
+NIC_DROP_RE = re.compile(r"drop|miss|discard|no_?buf")
+# Printed by "doctor.py partials" before the accumulators it collected
+PARTIALS_MARK = "==doctor-partials=="
+# Corrupt JSON log lines reported per file, the rest are just counted
+MAX_CORRUPT_LINES = 5
+# doctor watch: rolling window used without --window, the number of
+# buckets it is kept in, and how often the current logs are read
+WATCH_WINDOW = 300
+WATCH_BUCKETS = 10
+WATCH_POLL = 1.0
+# Reporter message templates counted, and how many are shown
+REPORTER_TEMPLATES = 200
+REPORTER_SHOWN = 10
+# Flows counted for the heaviest by bytes, and how many are shown per worker
+HEAVY_FLOWS = 1000
+HEAVY_FLOWS_SHOWN = 3
+# GzipIndex points are this far apart in the uncompressed data, and each
+# keeps the window of data before it that inflation can refer back to
+GZINDEX_SPAN = 4 * 1024 * 1024
+GZINDEX_WINDOW = 32768
+GZINDEX_MAX_BYTES = 256 * 1024 * 1024
+# --sample reads this much at each point first, and lines can be this long
+SAMPLE_WINDOW = 64 * 1024
+SAMPLE_MAX_LINE = 64 * 1024
+# The proportion checks stop once the interval at this z (99.9%, wide enough
+# for looking again every PROPORTION_STEP records) clears their threshold,
+# and read at most PROPORTION_MAX_RECORDS when it doesn't
+PROPORTION_Z = 3.29
+PROPORTION_STEP = 1000
+PROPORTION_MAX_RECORDS = 1000000
 
 NODE_KEYS = {"_node_name", "node", "peer"}
+# Projected column that resolves to whichever of NODE_KEYS a log has
+NODE_COLUMN = "node"
+
+def parse_duration(s):
+    """Parse a duration like 90s, 15m, 1h or 2d into seconds"""
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+    if s[-1:] in units:
+        return float(s[:-1]) * units[s[-1]]
+    return float(s)
+
+def format_duration(seconds):
+    """Format seconds in the largest whole unit parse_duration reads"""
+    for unit, size in ("d", 86400), ("h", 3600), ("m", 60):
+        if seconds >= size and seconds % size == 0:
+            return "{:g}{}".format(seconds / size, unit)
+    return "{:g}s".format(seconds)
+
+# cmd_custom --options: name -> (default, converter or None for a flag)
+OPTIONS = {
+    "jobs": (1, int),
+    "no_cache": (False, None),
+    "duplicate_sketch": (0, int),
+    "window": (None, parse_duration),
+    "profile": (False, None),
+    "interval": (10, parse_duration),
+    "count": (0, int),
+    "loggers": (False, None),
+    "sample": (False, None),
+}
+
+# Per-run I/O counters, reset by reset_run_state: opens, bytes_read (from
+# disk), bytes_decompressed, records_parsed, records_used, remote_commands
+# and remote_seconds
+io_stats = defaultdict(int)
 
 RED = '\033[91m'
 ENDC = '\033[0m'
@@ -49,35 +193,112 @@ def all_lowercase(s):
 def all_uppercase(s):
     return all(c in uppercase_chars for c in s)
 
+# history_flags bits
+HISTORY_ONE_SIDED = 1      # all upper or all lower case, ignoring ^
+HISTORY_FLIPPED = 2        # has ^
+HISTORY_HANDSHAKE = 4      # has h or H
+HISTORY_SINGLE_PACKET = 8  # one letter, ignoring ^
+# Distinct histories remembered by history_flags before starting over
+HISTORY_CACHE_SIZE = 100000
+
+_history_flags = {}
+def history_flags(history):
+    """Return the HISTORY_ bits that describe a conn log history
+
+    There are only a few thousand distinct histories in practice, so the
+    result is remembered and most calls are a dict lookup.
+    """
+    try:
+        return _history_flags[history]
+    except KeyError:
+        pass
+    h = history.replace("^", "")
+    flags = 0
+    if all_lowercase(h) or all_uppercase(h):
+        flags |= HISTORY_ONE_SIDED
+    if '^' in history:
+        flags |= HISTORY_FLIPPED
+    if 'h' in h.lower():
+        flags |= HISTORY_HANDSHAKE
+    if len(h) == 1:
+        flags |= HISTORY_SINGLE_PACKET
+    if len(_history_flags) >= HISTORY_CACHE_SIZE:
+        _history_flags.clear()
+    _history_flags[history] = flags
+    return flags
+
 def percent(a, b):
     try :
         return 100.0 * a / b
     except ZeroDivisionError:
         return 0.0
 
+def wilson_interval(hits, total, z=PROPORTION_Z):
+    """Return the Wilson score interval (low, high) for the proportion hits/total"""
+    if not total:
+        return 0.0, 1.0
+    p = float(hits) / total
+    z2 = z * z
+    centre = p + z2 / (2.0 * total)
+    half = z * sqrt(p * (1 - p) / total + z2 / (4.0 * total * total))
+    scale = 1 + z2 / total
+    return max(0.0, (centre - half) / scale), min(1.0, (centre + half) / scale)
+
+def parse_ts(ts):
+    """Return a log timestamp as seconds since the epoch
+
+    Handles the plain epoch times of ASCII and default JSON logs and the
+    ISO 8601 times written by JSON logs with LogAscii::json_timestamps.
+    """
+    try:
+        return float(ts)
+    except ValueError:
+        seconds = calendar.timegm(time.strptime(ts[:19], "%Y-%m-%dT%H:%M:%S"))
+        fraction = re.match(r"\.\d+", ts[19:])
+        return seconds + (float(fraction.group()) if fraction else 0.0)
+
+def cpu_time():
+    """CPU seconds used by this process and its finished children, like --jobs workers"""
+    t = os.times()
+    return t[0] + t[1] + t[2] + t[3]
+
 def get_os_type():
     uname = os.uname()
     ostype = uname[0]
     return ostype
 
-_node_key = None
-def get_node_name(rec):
-    global _node_key
-    if not _node_key:
-        nks = NODE_KEYS & set(rec.keys())
-        try:
-            _node_key = nks.pop()
-        except KeyError:
-            raise
-
-    return rec.get(_node_key)
-
-def bro_ascii_reader(f):
+_record_types = {}
+def record_type(columns):
+    """Return the namedtuple used for records projected onto columns
+
+    Dots and leading underscores are dropped from the attribute names, so
+    'id.orig_h' is read as rec.id_orig_h.  Columns a log does not have are None.
+    """
+    try:
+        return _record_types[columns]
+    except KeyError:
+        names = [c.replace(".", "_").lstrip("_") for c in columns]
+        rt = _record_types[columns] = namedtuple("Record", names)
+        return rt
+
+def projected_node_key(keys):
+    for k in sorted(NODE_KEYS):
+        if k in keys:
+            return k
+
+def bro_ascii_reader(f, columns=None, rows=iter, match=None):
+    """Yield the records of an ASCII log as dicts, or record_type(columns) tuples
+
+    rows turns f, positioned after the header, into the data lines to read.
+    match is only used by bro_json_reader.
+    """
     line = ''
     headers = {}
-    it = iter(f)
     while not line.startswith("#types"):
-        line = next(it).rstrip().decode('latin-1')
+        line = f.readline()
+        if not line:
+            return
+        line = line.rstrip().decode('latin-1')
         k,v = line[1:].split(None, 1)
         headers[k] = v
 
@@ -91,6 +312,12 @@ def bro_ascii_reader(f):
     fields = headers['fields']
     types = headers['types']
     set_sep = headers['set_separator']
+    it = rows(f)
+
+    if columns is not None:
+        for rec in _bro_ascii_projection(it, fields, types, sep, set_sep, columns):
+            yield rec
+        return
 
     vectors = [field for field, type in zip(fields, types) if type.startswith("vector[")]
 
@@ -103,70 +330,2137 @@ def bro_ascii_reader(f):
             rec[f] = rec[f].split(set_sep)
         yield rec
 
-def bro_json_reader(f):
-    for line in f:
+def _bro_ascii_projection(it, fields, types, sep, set_sep, columns):
+    """Yield record_type(columns) tuples, splitting each row only as far as the last wanted column"""
+    Record = record_type(columns)
+    index = dict((f, i) for i, f in enumerate(fields))
+    node_key = projected_node_key(index)
+    idx = [index.get(node_key if c == NODE_COLUMN else c) for c in columns]
+    present = [i for i in idx if i is not None]
+    last = max(present) if present else -1
+    # Only the final column carries the line terminator
+    strip = last == len(fields) - 1
+    vectors = [p for p, i in enumerate(idx) if i is not None and types[i].startswith("vector[")]
+
+    if None in idx:
+        getter = lambda parts: [parts[i] if i is not None else None for i in idx]
+    elif len(idx) == 1:
+        getter = lambda parts, i=idx[0]: (parts[i],)
+    else:
+        getter = itemgetter(*idx)
+    new = tuple.__new__
+
+    for row in it:
+        row = row.decode('latin-1')
+        if row.startswith("#close"): break
+        if strip:
+            row = row.rstrip()
+        values = getter(row.split(sep, last + 1))
+        if vectors:
+            values = list(values)
+            for p in vectors:
+                values[p] = values[p].split(set_sep)
+        yield new(Record, values)
+
+def bro_json_reader(f, columns=None, rows=iter, match=None):
+    """Yield the records of a JSON log, see bro_ascii_reader
+
+    match is a (column, string) pair: lines that plainly hold some other
+    string for column are yielded as None without being decoded.
+    """
+    if columns is not None:
+        Record = record_type(columns)
+        new = tuple.__new__
+        keys = None
+    if match is not None:
+        # Only compact lines are skipped, "column":"value" rather than "column": "value"
+        needle = (json.dumps(match[0]) + ':' + json.dumps(match[1])).encode('latin-1')
+        key = (json.dumps(match[0]) + ':"').encode('latin-1')
+    loads = fast_json.loads
+    corrupt = 0
+    for line in rows(f):
+        if match is not None and needle not in line and key in line:
+            yield None
+            continue
         try:
-            yield json.loads(line)
-        except Exception as e:
-            sys.stderr.write("Skipping corrupt json log line: {!r}\n".format(line))
+            rec = loads(line)
+        except ValueError:
+            corrupt += 1
+            if corrupt <= MAX_CORRUPT_LINES:
+                sys.stderr.write("Skipping corrupt json log line: {!r}\n".format(line))
+            continue
+        if columns is None:
+            yield rec
+            continue
+        if keys is None:
+            # Every record of a log names its node with the same key
+            node_key = projected_node_key(rec)
+            keys = [node_key if c == NODE_COLUMN else c for c in columns]
+            getter = None
+            if None not in keys:
+                getter = itemgetter(*keys) if len(keys) > 1 else lambda rec, k=keys[0]: (rec[k],)
+        if getter is not None:
+            try:
+                yield new(Record, getter(rec))
+                continue
+            except KeyError:
+                # Unset fields are left out
+                pass
+        yield new(Record, [rec.get(k) for k in keys])
+    if corrupt > MAX_CORRUPT_LINES:
+        sys.stderr.write("Skipped {} more corrupt json log lines\n".format(corrupt - MAX_CORRUPT_LINES))
 
 def open_log(filename):
-    if filename.endswith(".log"):
-        return open(filename, 'rb')
-    if filename.endswith(".gz"):
-        return gzip.open(filename)
-    raise Exception("Unknown log extension: {}".format(filename))
-
-def read_bro_log(filename):
-    reader = None
-    with open_log(filename) as f:
-        first_byte = f.read(1).decode('latin-1')
+    ext = os.path.splitext(filename)[1]
+    if ext == ".log":
+        f = open(filename, 'rb')
+    elif ext in DECOMPRESS_COMMANDS:
+        f = open_compressed(filename, ext)
+    else:
+        raise Exception("Unknown log extension: {}".format(filename))
+    io_stats["opens"] += 1
+    return f
+
+_commands = {}
+def decompress_command(ext):
+    """Return the path of the first of DECOMPRESS_COMMANDS[ext] on the PATH, or None"""
+    try:
+        return _commands[ext]
+    except KeyError:
+        pass
+    found = None
+    for name in DECOMPRESS_COMMANDS[ext]:
+        for d in os.environ.get("PATH", os.defpath).split(os.pathsep):
+            path = os.path.join(d, name)
+            if os.path.isfile(path) and os.access(path, os.X_OK):
+                found = path
+                break
+        if found:
+            break
+    _commands[ext] = found
+    return found
+
+def cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+def open_compressed(filename, ext):
+    """Open a rotated log through the fastest decompressor available
+
+    With a spare CPU an external pigz, gzip, zstd or lz4 decompresses the log
+    while it is being parsed.  Otherwise gzip logs are inflated with zlib in
+    DECOMPRESS_BLOCK reads, and zstd and lz4 logs with their Python modules
+    if they are installed.
+    """
+    in_process = ext == ".gz" or (ext == ".zst" and zstandard) or (ext == ".lz4" and lz4_frame)
+    command = decompress_command(ext)
+    compressed = open(filename, 'rb')
+    try:
+        process = None
+        if command and (cpu_count() > 1 or not in_process):
+            process = subprocess.Popen([command, "-dc"], stdin=compressed,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            chunks = pipe_chunks(process, filename)
+        elif ext == ".gz":
+            chunks = zlib_chunks(compressed)
+        elif ext == ".zst" and zstandard:
+            chunks = zstandard.ZstdDecompressor().read_to_iter(compressed, read_size=DECOMPRESS_BLOCK)
+        elif ext == ".lz4" and lz4_frame:
+            reader = lz4_frame.open(compressed)
+            chunks = iter(lambda: reader.read(DECOMPRESS_BLOCK), b'')
+        else:
+            raise Exception("Can't read {}, install {} or the Python {} module".format(
+                filename, DECOMPRESS_COMMANDS[ext][0], "zstandard" if ext == ".zst" else "lz4"))
+    except Exception:
+        compressed.close()
+        raise
+    return io.BufferedReader(DecompressedLog(compressed, chunks, process), DECOMPRESS_BLOCK)
+
+def zlib_chunks(f):
+    """Yield the contents of the gzip file f, which may have several members
+
+    Decompress objects only have eof on Python 3, but on both a member has
+    ended once input is left over in unused_data.
+    """
+    d = None
+    for data in iter(lambda: f.read(DECOMPRESS_BLOCK), b''):
+        while data:
+            if d is None:
+                # Members can be followed by zero padding, like the gzip module allows
+                data = data.lstrip(b'\0')
+                if not data:
+                    break
+                d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            yield d.decompress(data)
+            data = d.unused_data
+            if data:
+                d = None
+    if d is not None and not _member_ended(d):
+        raise EOFError("{} ended before the end of its gzip stream".format(f.name))
+
+def _member_ended(d):
+    # Input after the end of a member is left in unused_data, while a
+    # member cut short takes it in or fails on it
+    try:
+        d.decompress(b'\0')
+    except zlib.error:
+        return False
+    return bool(d.unused_data)
+
+def pipe_chunks(process, filename):
+    """Yield the output of the decompressor process, raising an error if it fails"""
+    fd = process.stdout.fileno()
+    for chunk in iter(lambda: os.read(fd, DECOMPRESS_BLOCK), b''):
+        yield chunk
+    error = process.stderr.read().decode('utf-8', 'replace').strip()
+    if process.wait():
+        raise IOError("Failed to decompress {}: {}".format(filename, error))
+
+class DecompressedLog(io.RawIOBase):
+    """The decompressed contents of a rotated log, as a raw stream of chunks
+
+    tell() is the number of decompressed bytes so far, and bytes_read() how
+    much of the compressed file has been read, by us or the process.
+    """
+    def __init__(self, compressed, chunks, process=None):
+        self.compressed = compressed
+        self.chunks = chunks
+        self.process = process
+        self.chunk = b''
+        self.offset = 0
+        self.decompressed = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self.offset == len(self.chunk):
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return 0
+            self.chunk, self.offset = chunk, 0
+        n = min(len(b), len(self.chunk) - self.offset)
+        b[:n] = memoryview(self.chunk)[self.offset:self.offset + n]
+        self.offset += n
+        self.decompressed += n
+        return n
+
+    def tell(self):
+        return self.decompressed
+
+    def bytes_read(self):
+        # The process shares our file's offset
+        return os.lseek(self.compressed.fileno(), 0, os.SEEK_CUR)
+
+    def close(self):
+        if not self.closed:
+            if self.process is not None:
+                if self.process.poll() is None:
+                    self.process.kill()
+                self.process.wait()
+                self.process.stdout.close()
+                self.process.stderr.close()
+            self.compressed.close()
+        super(DecompressedLog, self).close()
+
+Z_NO_FLUSH, Z_BLOCK = 0, 5
+Z_STREAM_END, Z_NEED_DICT, Z_BUF_ERROR = 1, 2, -5
+
+class ZStream(ctypes.Structure):
+    _fields_ = [
+        ("next_in", ctypes.c_void_p), ("avail_in", ctypes.c_uint), ("total_in", ctypes.c_ulong),
+        ("next_out", ctypes.c_void_p), ("avail_out", ctypes.c_uint), ("total_out", ctypes.c_ulong),
+        ("msg", ctypes.c_char_p), ("state", ctypes.c_void_p),
+        ("zalloc", ctypes.c_void_p), ("zfree", ctypes.c_void_p), ("opaque", ctypes.c_void_p),
+        ("data_type", ctypes.c_int), ("adler", ctypes.c_ulong), ("reserved", ctypes.c_ulong),
+    ]
+
+_libz = []
+def load_libz():
+    """Return the system zlib through ctypes, or None if it can't be loaded"""
+    if not _libz:
+        try:
+            libz = ctypes.CDLL(ctypes.util.find_library("z") or "libz.so.1")
+            libz.zlibVersion.restype = ctypes.c_char_p
+            libz.inflatePrime
+        except (OSError, AttributeError):
+            libz = None
+        _libz.append(libz)
+    return _libz[0]
+
+class Inflater(object):
+    """An inflate stream of the system zlib, for the calls the zlib module lacks
+
+    wbits is as for zlib.decompressobj.  Input is fed from f in reads of
+    block bytes, counted in io_stats.
+    """
+    def __init__(self, f, wbits, block=DECOMPRESS_BLOCK):
+        self.libz = load_libz()
+        self.f = f
+        self.block = block
+        self.strm = ZStream()
+        self.ref = ctypes.byref(self.strm)
+        self.inbuf = ctypes.create_string_buffer(block)
+        self._check(self.libz.inflateInit2_(self.ref, wbits, self.libz.zlibVersion(), ctypes.sizeof(ZStream)))
+
+    def _check(self, ret):
+        if ret < 0 and ret != Z_BUF_ERROR:
+            raise zlib.error("Error {} inflating {}: {}".format(ret, self.f.name, self.strm.msg))
+        return ret
+
+    def fill(self):
+        """Read more input once the last is used up, returning False at the end of f"""
+        if self.strm.avail_in:
+            return True
+        data = self.f.read(self.block)
+        io_stats["bytes_read"] += len(data)
+        ctypes.memmove(self.inbuf, data, len(data))
+        self.strm.next_in = ctypes.addressof(self.inbuf)
+        self.strm.avail_in = len(data)
+        return bool(data)
+
+    def inflate(self, flush=Z_NO_FLUSH):
+        return self._check(self.libz.inflate(self.ref, flush))
+
+    def skip_padding(self):
+        """Skip the zero bytes gzip allows after a member, returning how many"""
+        data = ctypes.string_at(self.strm.next_in, self.strm.avail_in)
+        n = len(data) - len(data.lstrip(b'\0'))
+        self.strm.next_in += n
+        self.strm.avail_in -= n
+        return n
+
+    def reset(self):
+        self._check(self.libz.inflateReset(self.ref))
+
+    def prime(self, bits, value):
+        self._check(self.libz.inflatePrime(self.ref, bits, value))
+
+    def set_dictionary(self, data):
+        self._check(self.libz.inflateSetDictionary(self.ref, data, len(data)))
+
+    def end(self):
+        self.libz.inflateEnd(self.ref)
+
+class GzipIndex(object):
+    """Points to start inflating a gzip file from the middle, like zlib's zran.c
+
+    Each point is where a deflate block starts, as (offset in the
+    uncompressed data, offset in the file, bits of the byte before that
+    belong to the block, the GZINDEX_WINDOW bytes of data before it,
+    compressed).  Points are about GZINDEX_SPAN apart, and building the
+    index takes one pass over the file.  Needs the system zlib, load_libz.
+    """
+    def __init__(self, points, size):
+        self.points = points
+        self.size = size
+
+    @classmethod
+    def build(cls, f, span=GZINDEX_SPAN):
+        z = Inflater(f, 32 + 15)
+        window = ctypes.create_string_buffer(GZINDEX_WINDOW)
+        strm = z.strm
+        points = []
+        totin = totout = last = 0
+        ended = False
+        try:
+            while z.fill():
+                if ended:
+                    # Another member or zero padding may follow
+                    totin += z.skip_padding()
+                    if not strm.avail_in:
+                        continue
+                    z.reset()
+                    ended = False
+                if not strm.avail_out:
+                    strm.next_out = ctypes.addressof(window)
+                    strm.avail_out = GZINDEX_WINDOW
+                totin += strm.avail_in
+                totout += strm.avail_out
+                ret = z.inflate(Z_BLOCK)
+                totin -= strm.avail_in
+                totout -= strm.avail_out
+                if ret == Z_NEED_DICT:
+                    raise zlib.error("{} needs a dictionary".format(f.name))
+                if ret == Z_STREAM_END:
+                    ended = True
+                elif strm.data_type & 128 and not strm.data_type & 64 and (totout == 0 or totout - last > span):
+                    # At a block boundary, the window holds the last data
+                    # written, wrapped around at avail_out
+                    left = strm.avail_out
+                    data = window.raw
+                    data = data[GZINDEX_WINDOW - left:] + data[:GZINDEX_WINDOW - left]
+                    points.append((totout, totin, strm.data_type & 7, zlib.compress(data)))
+                    last = totout
+        finally:
+            z.end()
+        if not ended:
+            raise EOFError("{} ended before the end of its gzip stream".format(f.name))
+        io_stats["bytes_decompressed"] += totout
+        return cls(points, totout)
+
+    def read(self, f, point, length):
+        """Return length bytes of data from the point-th point on, less at the end of a member"""
+        out, offset, bits, window = self.points[point]
+        # Logs compress several times over, so small reads waste little
+        z = Inflater(f, -15, min(DECOMPRESS_BLOCK, max(length // 4, 16384)))
+        strm = z.strm
+        buf = ctypes.create_string_buffer(length)
+        try:
+            f.seek(offset - (1 if bits else 0))
+            if bits:
+                byte = bytearray(f.read(1))[0]
+                z.prime(bits, byte >> (8 - bits))
+            z.set_dictionary(zlib.decompress(window))
+            strm.next_out = ctypes.addressof(buf)
+            strm.avail_out = length
+            while strm.avail_out and z.fill():
+                if z.inflate() == Z_STREAM_END:
+                    break
+        finally:
+            z.end()
+        n = length - strm.avail_out
+        io_stats["bytes_decompressed"] += n
+        return buf.raw[:n]
+
+def gzip_index(filename, cache=None):
+    """Return the GzipIndex of filename, from cache if it has one"""
+    index = cache.get(filename) if cache is not None else None
+    if index is None:
+        with open(filename, 'rb') as f:
+            io_stats["opens"] += 1
+            index = GzipIndex.build(f)
+        if cache is not None:
+            cache.put(filename, index)
+    return index
+
+def sniff_log(filename):
+    """Open filename and work out which reader it needs
+
+    Returns (reader, f) with f still at the start of the file, or (None, None)
+    for an empty log.
+    """
+    f = open_log(filename)
+    try:
+        if hasattr(f, "peek"):
+            first_byte = f.peek(1)[:1]
+        else:
+            first_byte = f.read(1)
+            f.seek(0)
+        first_byte = first_byte.decode('latin-1')
         if first_byte == '#':
-            reader = bro_ascii_reader
+            return bro_ascii_reader, f
         elif first_byte == '{':
-            reader = bro_json_reader
+            return bro_json_reader, f
         elif first_byte == '':
             #empty log file
-            return
+            f.close()
+            return None, None
         else:
             raise Exception("Unknown bro log type for file {}, first line: {!r}".format(filename, f.readline().strip()))
+    except Exception:
+        f.close()
+        raise
+
+def map_file(f, size):
+    """Return a read only mmap of the first size bytes of f, or None if it can't be mapped
+
+    Logs in current/ are renamed, not truncated, when they are rotated, so
+    the mapping stays valid while Bro keeps appending to the file.
+    """
+    if not size:
+        return None
+    try:
+        return mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+    except (EnvironmentError, ValueError, io.UnsupportedOperation):
+        return None
+
+def reverse_lines(f, start=0, blocksize=REVERSE_BLOCK_SIZE):
+    """Yield the data lines of f after offset start, last line first
+
+    The file is read backwards a block at a time.  A final line without a
+    newline is still being written and is skipped, as are # lines.  Plain
+    files are memory mapped, so blocks are sliced straight out of the page
+    cache instead of being read through the file object's buffer.
+    """
+    f.seek(0, os.SEEK_END)
+    pos = f.tell()
+    data = map_file(f, pos)
+    if data is None:
+        def block(pos, size):
+            f.seek(pos)
+            return f.read(size)
+    else:
+        block = lambda pos, size: data[pos:pos + size]
+    tail = b''
+    incomplete = True
+    try:
+        while pos > start:
+            size = min(blocksize, pos - start)
+            pos -= size
+            lines = (block(pos, size) + tail).split(b'\n')
+            io_stats["bytes_read"] += size
+            io_stats["bytes_decompressed"] += size
+            tail = lines.pop(0)
+            if incomplete:
+                if not lines:
+                    continue
+                lines.pop()
+                incomplete = False
+            for line in reversed(lines):
+                if line and not line.startswith(b'#'):
+                    yield line
+        if tail and not incomplete and not tail.startswith(b'#'):
+            yield tail
+    finally:
+        if data is not None:
+            data.close()
+
+def tail_lines(f, limit=None):
+    """Return the last limit data lines of f, last line first
+
+    For compressed logs that can't be read backwards; only limit lines are
+    kept in memory.
+    """
+    ring = deque((line for line in f if not line.startswith(b'#')), maxlen=limit)
+    ring.reverse()
+    return ring
+
+def read_bro_log(filename, columns=None, newest_first=False, limit=None, match=None):
+    """Yield the records in filename
+
+    Records are dicts, or record_type(columns) tuples when a tuple of column
+    names is given, which is much cheaper for checks that only look at a few.
+    With a match, see bro_json_reader, some records may come out as None.
+
+    With newest_first the records are read from the end of the file, so that
+    a limit on the number of records samples the most recent ones.  Plain
+    logs are read backwards; for compressed logs only the last limit lines
+    are kept.
+    """
+    reader, f = sniff_log(filename)
+    if reader is None:
+        return
+
+    rows = iter
+    backwards = newest_first and filename.endswith(".log")
+    if backwards:
+        rows = lambda f: reverse_lines(f, f.tell())
+    elif newest_first:
+        rows = lambda f: tail_lines(f, limit)
+
+    parsed = 0
+    try:
+        for rec in reader(f, columns, rows, match):
+            if rec is not None:
+                parsed += 1
+            yield rec
+    finally:
+        io_stats["records_parsed"] += parsed
+        if not backwards:
+            # reverse_lines counts its own reads
+            io_stats["bytes_decompressed"] += f.tell()
+            raw = getattr(f, "raw", None)
+            io_stats["bytes_read"] += raw.bytes_read() if isinstance(raw, DecompressedLog) else f.tell()
+        f.close()
+
+_listings = {}
+def listdir(path):
+    """Sorted os.listdir, remembered until reset_run_state
+
+    A missing directory lists as empty.
+    """
+    try:
+        return _listings[path]
+    except KeyError:
+        try:
+            entries = sorted(os.listdir(path))
+        except OSError:
+            entries = []
+        _listings[path] = entries
+        return entries
+
+def reset_run_state():
+    _listings.clear()
+    _indexes.clear()
+    io_stats.clear()
+
+_rotation_times = re.compile(r"\.(\d\d):(\d\d):(\d\d)-(\d\d):(\d\d):(\d\d)\.")
+def log_file_interval(filename):
+    """Return the (start, end) times covered by a rotated log, or None if unknown
+
+    Rotated logs are archived as logdir/YYYY-MM-DD/conn.HH:MM:SS-HH:MM:SS.log.gz
+    in local time.
+    """
+    day = os.path.basename(os.path.dirname(filename))
+    m = _rotation_times.search(os.path.basename(filename))
+    if not m:
+        return None
+    try:
+        midnight = time.mktime(time.strptime(day, "%Y-%m-%d"))
+    except ValueError:
+        return None
+    h1, m1, s1, h2, m2, s2 = [int(x) for x in m.groups()]
+    start = midnight + h1 * 3600 + m1 * 60 + s1
+    end = midnight + h2 * 3600 + m2 * 60 + s2
+    if end <= start:
+        end += 86400
+    return start, end
+
+def window_boundary(filename, since):
+    """Does filename possibly hold records from before since?
+
+    Records can start up to WINDOW_SLACK before the log they are written to
+    was opened.  Logs that are still being written have no known interval.
+    """
+    if since is None:
+        return False
+    interval = log_file_interval(filename)
+    return interval is None or interval[0] - WINDOW_SLACK < since
+
+# A log in a LogIndex; end is None unless it is a rotated log
+LogFile = namedtuple("LogFile", "path end")
+
+class LogIndex(object):
+    """The logs in a log directory, each listed and parsed once per run
+
+    Archived day directories are only listed when a query reaches back to
+    them.  With a ListingCache their listings are kept across runs until
+    the directory's mtime changes; current/ is always listed.
+    """
+    def __init__(self, base_dir, cache=None):
+        self.base_dir = base_dir
+        self.cache = cache
+        #Fix in 983 years
+        self.days = [d for d in listdir(base_dir) if d.startswith("20")]
+        self._dirs = {}
+
+    def directory(self, name):
+        """Return [(file name, LogFile)] for the directory name in base_dir"""
+        try:
+            return self._dirs[name]
+        except KeyError:
+            pass
+        path = os.path.join(self.base_dir, name)
+        names = mtime = None
+        if self.cache is not None and name != "current":
+            try:
+                mtime = os.stat(path).st_mtime
+                names = self.cache.get(path, mtime)
+            except OSError:
+                pass
+        if names is None:
+            names = listdir(path)
+            if mtime is not None:
+                self.cache.put(path, mtime, names)
+        files = []
+        for f in names:
+            full = os.path.join(path, f)
+            interval = log_file_interval(full)
+            files.append((f, LogFile(full, interval[1] if interval else None)))
+        self._dirs[name] = files
+        return files
+
+    def files(self, glob_pattern, days=7, since=None):
+        """Return the LogFiles matching glob_pattern from the last days of archives and current/
+
+        If since is given, days is ignored and only logs that cover any time
+        after since are returned, like "conn logs covering the last 6 hours".
+        """
+        if since is None:
+            dirs = self.days[-days:]
+        else:
+            first_day = time.strftime("%Y-%m-%d", time.localtime(since - 86400))
+            dirs = [d for d in self.days if d >= first_day]
+        match = re.compile(fnmatch.translate(glob_pattern)).match
+        return [lf for d in dirs + ["current"] for f, lf in self.directory(d)
+                if match(f) and (since is None or lf.end is None or lf.end >= since)]
+
+_indexes = {}
+def log_index(base_dir, cache=None):
+    """The LogIndex of base_dir for this run, created with cache if there is none yet"""
+    try:
+        return _indexes[base_dir]
+    except KeyError:
+        index = _indexes[base_dir] = LogIndex(base_dir, cache)
+        return index
+
+def find_recent_log_files(base_dir, glob_pattern,  days=7, since=None):
+    """Return the paths of the logs matching glob_pattern, see LogIndex.files"""
+    recent_log_files = []
+    for lf in log_index(base_dir).files(glob_pattern, days, since):
+        if lf.path.endswith(LOG_EXTENSIONS):
+            recent_log_files.append(lf.path)
+        else:
+            sys.stdout.write("warning: Unknown log extension: {}\n".format(lf.path))
 
-    f = open_log(filename)
-    for rec in reader(f):
-        yield rec
-    f.close()
+    return recent_log_files
 
-def read_bro_logs_with_line_limit(filenames, limit=10000):
-    # TODO: just use itertools.islice?
-    for f in filenames:
-        for rec in read_bro_log(f):
+class SpaceSaving(object):
+    """Top-k heavy hitters of a weighted stream in at most size counters
+
+    The Space-Saving algorithm (Metwally et al.): once all counters are in
+    use, a new key takes over the smallest one, inheriting its count as the
+    error.  A key's count overestimates its weight by at most its error,
+    and any key weighing more than the total / size is sure to be counted.
+    Each counter also holds a value for the caller, None for a new key.
+    """
+    def __init__(self, size):
+        self.size = size
+        # key: [count, error, value]
+        self.counters = {}
+        # (count, key) for every key, possibly lower than its current count
+        self.heap = []
+
+    def add(self, key, weight=1):
+        """Count weight for key, returning its [count, error, value] counter"""
+        counter = self.counters.get(key)
+        if counter is not None:
+            counter[0] += weight
+            return counter
+        if len(self.counters) < self.size:
+            counter = self.counters[key] = [weight, 0, None]
+        else:
+            floor = self._evict()
+            counter = self.counters[key] = [floor + weight, floor, None]
+        heappush(self.heap, (counter[0], key))
+        return counter
+
+    def _evict(self):
+        while True:
+            count, key = heappop(self.heap)
+            current = self.counters[key][0]
+            if current == count:
+                del self.counters[key]
+                return count
+            heappush(self.heap, (current, key))
+
+    def floor(self):
+        """The most any key without a counter can weigh"""
+        if len(self.counters) < self.size:
+            return 0
+        return min(counter[0] for counter in self.counters.values())
+
+    def merge(self, other, merge_values):
+        """Fold in the counters of other, with merge_values(ours, theirs) for keys in both"""
+        floor, other_floor = self.floor(), other.floor()
+        counters = {}
+        for key, (count, error, value) in self.counters.items():
+            theirs = other.counters.get(key)
+            if theirs is None:
+                counters[key] = [count + other_floor, error + other_floor, value]
+            else:
+                counters[key] = [count + theirs[0], error + theirs[1], merge_values(value, theirs[2])]
+        for key, (count, error, value) in other.counters.items():
+            if key not in counters:
+                counters[key] = [count + floor, error + floor, value]
+        self.counters = dict(nlargest(self.size, counters.items(), key=lambda item: item[1][0]))
+        self.heap = [(counter[0], key) for key, counter in self.counters.items()]
+        heapify(self.heap)
+
+    def top(self, n=None):
+        """Return [(key, count, error, value)] for the n largest counts, largest first"""
+        items = sorted(self.counters.items(), key=lambda item: (-item[1][0], item[0]))[:n]
+        return [(key, count, error, value) for key, (count, error, value) in items]
+
+class Accumulator(object):
+    """Streaming consumer for one check's share of a log scan
+
+    add() is handed each record the check would have read on its own and
+    limit caps how many records that is, across the logs (see recent).
+    Records are projected onto the union of the columns every accumulator in
+    the scan asks for, so add() reads fields as attributes (see record_type).
+    A limit of None means every record is wanted.
+
+    If add() ignores every record without some value for a column, set
+    prefilter to that (column, value) so the JSON reader can skip other lines
+    without decoding them; those are fed as None.
+
+    Once done is set the scan stops feeding this accumulator.  An exception
+    raised by add() is kept in failure so it only affects its own check.
+    Accumulators are pickled to move partial results between processes and
+    into the PartialCache.
+    """
+    limit = 10000
+    # Whether the limit should take the latest records.  Otherwise
+    # compressed logs are read from the start, and only until done.
+    recent = True
+    # Whether merging the partials of each file gives the same result as
+    # reading them in order, see scan_logs_by_file
+    mergeable = True
+    columns = ()
+    prefilter = None
+    failure = None
+    # Bump when the partial results change, to invalidate cached ones
+    version = 2
+    cache_partials = True
+
+    def __init__(self):
+        self.seen = 0
+        self.done = False
+
+    @classmethod
+    def from_options(cls, options):
+        """Return the accumulator to use given the cmd_custom OPTIONS"""
+        return cls()
+
+    def feed(self, rec):
+        if rec is not None:
+            self.add(rec)
+        self.seen += 1
+        if self.limit is not None and self.seen >= self.limit:
+            self.done = True
+
+    def add(self, rec):
+        raise NotImplementedError
+
+    def partial(self):
+        """Return an empty accumulator with the same settings, for scanning a single file"""
+        p = self.__class__()
+        p.limit = self.limit
+        return p
+
+    def self_contained_partial(self):
+        """Like partial(), for records that can't be read again once merged
+
+        Used by doctor watch and on logger nodes, where complete() can't run.
+        """
+        return self.partial()
+
+    def complete(self, filenames, jobs, since):
+        """Fill in what the partials merged from filenames left out, see scan_logs_by_file"""
+
+    def merge(self, other):
+        """Fold in the partial result other, which was read from the records following ours"""
+        self.combine(other)
+        self.seen += other.seen
+        self.failure = self.failure or other.failure
+        if self.limit is not None and self.seen >= self.limit or self.failure:
+            self.done = True
+        # other stopped before reaching its limit, so we would have too
+        if other.done and (other.limit is None or other.seen < other.limit):
+            self.done = True
+
+    def combine(self, other):
+        raise NotImplementedError
+
+def _window_records(records, since, newest_first):
+    """Drop records from before since, stopping early when reading newest first"""
+    for rec in records:
+        ts = parse_ts(rec.ts)
+        if ts >= since:
             yield rec
-            limit -= 1
-            if limit == 0:
-                return
-        
+        elif newest_first and ts < since - WINDOW_SLACK:
+            return
 
-def find_recent_log_directories(base_dir, days=7):
-    dirs = os.listdir(base_dir)
-    dirs.sort()
-    #Fix in 983 years
-    return [os.path.join(base_dir, d) for d in dirs if d.startswith("20")][-days:]
+def scan_logs(filenames, accumulators, jobs=1, cache=None, since=None):
+    """Read filenames once, feeding every record to each accumulator until all are done
 
-def find_recent_log_files(base_dir, glob_pattern,  days=7):
-    dirs = find_recent_log_directories(base_dir, days)
-    matches = []
-    for d in dirs + ["current"]:
-        matches.extend(glob.glob(os.path.join(base_dir, d, glob_pattern)))
+    Each file is read newest record first, so pass filenames newest first too.
+    Compressed logs can only be read that way by keeping their last lines,
+    so when no record limit applies they are read from the start instead,
+    as they are for the accumulators that don't need the latest records.
 
-    recent_log_files = []
-    for m in matches:
+    If since is given, records from before then are skipped in the logs that
+    may hold any, see window_boundary.
+
+    With jobs > 1 or a PartialCache the files are handled one at a time
+    instead, see scan_logs_by_file.
+    """
+    if jobs > 1 or cache is not None:
+        return scan_logs_by_file(filenames, accumulators, jobs, cache, since)
+    active = [a for a in accumulators if not a.done]
+    columns, match = scan_columns(active, since)
+    for f in filenames:
+        if not active:
+            return
+        # Accumulators that want the same read of f share it
+        groups = {}
+        for a in active:
+            newest_first = f.endswith(".log") or a.limit is not None and a.recent
+            groups.setdefault(newest_first, []).append(a)
+        for newest_first, group in sorted(groups.items()):
+            limit = None
+            if newest_first and not f.endswith(".log"):
+                limit = max(a.limit - a.seen for a in group)
+            records = read_bro_log(f, columns, newest_first, limit, match)
+            if window_boundary(f, since):
+                records = _window_records(records, since, newest_first)
+            feed_records(records, group)
+        active = [a for a in active if not a.done]
+
+def scan_columns(accumulators, since):
+    """Return the columns to read for accumulators, and the prefilter they share if any"""
+    columns = []
+    for a in accumulators:
+        columns.extend(c for c in a.columns if c not in columns)
+    if since is not None and 'ts' not in columns:
+        columns.append('ts')
+    prefilters = set(a.prefilter for a in accumulators)
+    # Windows need the ts of every record
+    match = prefilters.pop() if len(prefilters) == 1 and since is None else None
+    return tuple(columns), match
+
+def feed_records(records, active):
+    """Feed records to the active accumulators until they are done, returning those still active"""
+    for rec in records:
+        for a in active:
+            try:
+                a.feed(rec)
+            except Exception:
+                a.failure = traceback.format_exc()
+                a.done = True
+        if any(a.done for a in active):
+            active = [a for a in active if not a.done]
+            if not active:
+                break
+    return active
+
+def fork_context():
+    """The multiprocessing context that forks, or the module on Python 2
+
+    Workers started any other way import doctor again, which they can't:
+    broctl only puts the plugin directory on sys.path while loading it.
+    """
+    if hasattr(multiprocessing, "get_context"):
+        return multiprocessing.get_context("fork")
+    return multiprocessing
+
+def _scan_file(job):
+    filename, accumulators, since = job
+    io_stats.clear()
+    scan_logs([filename], accumulators, since=since)
+    return accumulators, dict(io_stats)
+
+def _cacheable(filename, cache, since):
+    # Partials of logs at the edge of a --window depend on where it starts
+    return cache is not None and cache.cacheable(filename) and not window_boundary(filename, since)
+
+def _cached_partials(filename, accumulators, cache, since):
+    if not _cacheable(filename, cache, since):
+        return [None] * len(accumulators)
+    return [None if a.done or not a.cache_partials else cache.get(filename, a) for a in accumulators]
+
+def _store_partial(filename, partial, cache, since):
+    if _cacheable(filename, cache, since) and partial.cache_partials and not partial.failure:
+        cache.put(filename, partial)
+    return partial
+
+def _file_partials(filenames, accumulators, jobs, cache, since, serial=()):
+    """Yield (filename, partials) in order, with one partial per accumulator
+
+    Partials come from the cache where possible.  The rest are read from the
+    file, in this process or in a pool of jobs worker processes, and cached.
+    The entries for accumulators that are already done may be None.
+
+    The serial accumulators are fed each file in this process before it is
+    yielded, sharing the read of the partials made here.
+    """
+    if jobs <= 1:
+        for f in filenames:
+            partials = _cached_partials(f, accumulators, cache, since)
+            todo = [i for i, a in enumerate(accumulators) if partials[i] is None and not a.done]
+            computed = [accumulators[i].partial() for i in todo]
+            scan_logs([f], computed + list(serial), since=since)
+            for i, p in zip(todo, computed):
+                partials[i] = _store_partial(f, p, cache, since)
+            yield f, partials
+        return
+
+    work = []
+    for f in filenames:
+        partials = _cached_partials(f, accumulators, cache, since)
+        work.append((f, partials, [a.partial() for a, p in zip(accumulators, partials) if p is None]))
+    pool = fork_context().Pool(min(jobs, len(work)))
+    # Only jobs files are handed out at a time, so stopping early just waits
+    # for those.  terminate() can hang on a worker killed while sending.
+    queued = iter(work)
+    running = deque()
+    try:
+        while True:
+            for f, partials, todo in queued:
+                running.append((f, partials, pool.apply_async(_scan_file, ((f, todo, since),))))
+                if len(running) >= jobs:
+                    break
+            if not running:
+                break
+            f, partials, result = running.popleft()
+            scan_logs([f], serial, since=since)
+            computed, stats = result.get()
+            for k, v in stats.items():
+                io_stats[k] += v
+            computed = iter(computed)
+            yield f, [_store_partial(f, next(computed), cache, since) if p is None else p for p in partials]
+    finally:
+        pool.close()
+        pool.join()
+
+def scan_logs_by_file(filenames, accumulators, jobs=1, cache=None, since=None):
+    """Like scan_logs, but build a partial result per file and merge them in order
+
+    Partials are computed as if each file were the first one read, so a file
+    that holds more records than an accumulator still wants is read again
+    for just that accumulator with the remaining limit.  The result is the
+    same as reading the files in order.
+
+    Accumulators that aren't mergeable are fed the files in order in this
+    process instead, without the pool or the cache.  Each merged one is then
+    given the chance to complete() itself from the files.
+    """
+    filenames = list(filenames)
+    serial = [a for a in accumulators if not a.done and not a.mergeable]
+    active = [a for a in accumulators if not a.done and a.mergeable]
+    if not active:
+        scan_logs(filenames, serial, since=since)
+        return
+    partials = _file_partials(filenames, active, jobs, cache, since, serial)
+    merged = 0
+    try:
+        for f, parts in partials:
+            merged += 1
+            for a, p in zip(active, parts):
+                if a.done:
+                    continue
+                if a.limit is not None and p.seen > a.limit - a.seen:
+                    remaining = a.limit - a.seen
+                    p = a.partial()
+                    p.limit = remaining
+                    scan_logs([f], [p], since=since)
+                a.merge(p)
+            if all(a.done for a in active):
+                break
+    finally:
+        partials.close()
+    scan_logs(filenames[merged:], serial, since=since)
+    for a in active:
+        if not a.failure:
+            a.complete(filenames, jobs, since)
+
+def stratified_order(n, rng):
+    """Return range(n) in an order that spreads every prefix evenly, from a random start
+
+    Steps by the golden ratio, which leaves no large gaps at any length.
+    """
+    step = (sqrt(5) - 1) / 2
+    x = rng.random()
+    seen = bytearray(n)
+    order = []
+    for _ in range(2 * n):
+        i = int(x * n)
+        x = (x + step) % 1.0
+        if not seen[i]:
+            seen[i] = 1
+            order.append(i)
+    order.extend(i for i in range(n) if not seen[i])
+    return order
+
+def stratum_lines(data, lo, hi, at_start):
+    """Return the complete lines of data that start after offset lo and at most at hi
+
+    A line starting right at lo belongs to the data before, unless at_start
+    says data is the start of the file.  # lines are left out.
+    """
+    pos = 0 if at_start and lo == 0 else data.find(b'\n', lo) + 1
+    lines = []
+    if pos == 0 and not (at_start and lo == 0):
+        return lines
+    while pos <= hi:
+        nl = data.find(b'\n', pos)
+        if nl < 0:
+            break
+        if not data.startswith(b'#', pos):
+            lines.append(data[pos:nl])
+        pos = nl + 1
+    return lines
+
+def sample_logs(filenames, accumulators, index_cache=None, since=None):
+    """Feed accumulators a stratified random sample of the records in filenames
+
+    The logs are cut into strata at the points of their GzipIndex, or every
+    GZINDEX_SPAN bytes of plain logs.  The first SAMPLE_WINDOW of each
+    stratum is read in stratified_order until the accumulators are done,
+    then the rest of each in the same order, so only the windows read are
+    decompressed.  The order is seeded with the file names, so the same
+    logs give the same sample.
+
+    Returns False without reading anything if a log is not plain or gzip,
+    or the system zlib can't be loaded.
+    """
+    if not all(f.endswith((".log", ".gz")) for f in filenames):
+        return False
+    if any(f.endswith(".gz") for f in filenames) and load_libz() is None:
+        return False
+    active = [a for a in accumulators if not a.done]
+    columns, match = scan_columns(active, since)
+
+    strata = []
+    files = {}
+    for f in filenames:
+        if f.endswith(".gz"):
+            index = gzip_index(f, index_cache)
+            starts = [point[0] for point in index.points]
+            size = index.size
+        else:
+            index = None
+            size = os.path.getsize(f)
+            starts = list(range(0, size, GZINDEX_SPAN))
+        files[f] = [open(f, 'rb'), index, None]
+        io_stats["opens"] += 1
+        strata.extend((f, i, start, end) for i, (start, end) in enumerate(zip(starts, starts[1:] + [size])))
+
+    def read(f, i, start, skip, length):
+        """Read from skip bytes into the stratum, or from its start for gzip"""
+        fh, index, header = files[f]
+        if index is not None:
+            return 0, index.read(fh, i, skip + length)
+        fh.seek(start + skip)
+        data = fh.read(length)
+        io_stats["bytes_read"] += len(data)
+        io_stats["bytes_decompressed"] += len(data)
+        return skip, data
+
+    def header(f):
+        if files[f][2] is None:
+            data = read(f, 0, 0, 0, SAMPLE_WINDOW)[1]
+            lines = []
+            for line in data.split(b'\n'):
+                if not line.startswith(b'#'):
+                    break
+                lines.append(line + b'\n')
+            files[f][2] = b''.join(lines)
+        return files[f][2]
+
+    order = [strata[i] for i in stratified_order(len(strata), random.Random(" ".join(filenames)))]
+    try:
+        for lo, hi in (0, SAMPLE_WINDOW), (SAMPLE_WINDOW, None):
+            for f, i, start, end in order:
+                if not active:
+                    return True
+                stop = end - start if hi is None else min(hi, end - start)
+                if lo >= stop:
+                    continue
+                skip, data = read(f, i, start, lo, stop - lo + SAMPLE_MAX_LINE)
+                lines = stratum_lines(data, lo - skip, stop - skip, start + skip == 0)
+                io_stats["records_parsed"] += len(lines)
+                reader = bro_ascii_reader if header(f) else bro_json_reader
+                records = reader(io.BytesIO(header(f)), columns, lambda fh: lines, match)
+                if since is not None:
+                    records = _window_records(records, since, False)
+                active = feed_records(records, active)
+    finally:
+        for fh, index, _ in files.values():
+            fh.close()
+    return True
+
+class LogFollower(object):
+    """Follow a log that is still being written, like tail -F
+
+    poll() returns the records added since the last call, as read_bro_log
+    would with columns.  When the log is rotated or truncated the rest of the
+    old file is read before starting on the new one.  Only the header and a
+    partly written final line are kept between calls.
+    """
+    def __init__(self, filename, columns, from_start=False):
+        self.filename = filename
+        self.columns = columns
+        self.f = None
+        self._open(from_start)
+
+    def _open(self, from_start):
+        self.header = b''
+        self.header_done = False
+        self.tail = b''
         try:
-            open_log(m).close()
-            recent_log_files.append(m)
-        except Exception as e:
-            sys.stdout.write("warning: {}\n".format(str(e)))
+            # Python 2 file objects keep returning nothing once they hit EOF
+            self.f = io.open(self.filename, 'rb')
+        except (OSError, IOError):
+            self.f = None
+            return
+        io_stats["opens"] += 1
+        self.ino = os.fstat(self.f.fileno()).st_ino
+        if not from_start:
+            # Skip to the end, but keep the header to parse what comes next
+            for line in iter(self.f.readline, b''):
+                if not line.startswith(b'#') or not line.endswith(b'\n'):
+                    break
+                self._header_line(line.rstrip(b'\n'))
+            self.f.seek(0, os.SEEK_END)
+
+    def _header_line(self, line):
+        if not self.header_done:
+            self.header += line + b'\n'
+            self.header_done = line.startswith(b'#types')
+
+    def _read(self):
+        data = self.f.read()
+        io_stats["bytes_read"] += len(data)
+        io_stats["bytes_decompressed"] += len(data)
+        if not data:
+            return []
+        lines = (self.tail + data).split(b'\n')
+        self.tail = lines.pop()
+        rows = []
+        for line in lines:
+            if line.startswith(b'#'):
+                self._header_line(line)
+            elif line:
+                rows.append(line)
+        if not rows:
+            return []
+        io_stats["records_parsed"] += len(rows)
+        reader = bro_ascii_reader if self.header else bro_json_reader
+        return list(reader(io.BytesIO(self.header), self.columns, lambda f: rows))
+
+    def poll(self):
+        if self.f is None:
+            self._open(from_start=True)
+            if self.f is None:
+                return []
+        records = self._read()
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            st = None
+        if st is None or st.st_ino != self.ino or st.st_size < self.f.tell():
+            self.close()
+            if st is not None:
+                self._open(from_start=True)
+                records.extend(self._read())
+        return records
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+class PartialCache(object):
+    """SQLite cache of accumulator partials for rotated log files
+
+    Rotated logs never change, so a partial is keyed by the path, size and
+    mtime of its file and the class, version and limit of its accumulator.
+    The least recently used entries are evicted once the cached data grows
+    beyond max_bytes.
+    """
+    def __init__(self, filename, max_bytes=CACHE_MAX_BYTES):
+        self.db = sqlite3.connect(filename, timeout=60, check_same_thread=False)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS partials (
+            path TEXT, size INTEGER, mtime REAL, accumulator TEXT, data BLOB, last_used REAL,
+            PRIMARY KEY (path, size, mtime, accumulator))""")
+        self.max_bytes = max_bytes
+        self.now = time.time()
+
+    @staticmethod
+    def cacheable(filename):
+        # Logs in current/ are still being written to
+        return os.path.basename(os.path.dirname(filename)) != "current"
+
+    def _key(self, filename, acc):
+        st = os.stat(filename)
+        name = "{}/{}/{}".format(acc.__class__.__name__, acc.version, acc.limit)
+        return (filename, st.st_size, st.st_mtime, name)
+
+    def get(self, filename, acc):
+        key = self._key(filename, acc)
+        where = "path=? AND size=? AND mtime=? AND accumulator=?"
+        row = self.db.execute("SELECT data FROM partials WHERE " + where, key).fetchone()
+        if row is None:
+            return None
+        self.db.execute("UPDATE partials SET last_used=? WHERE " + where, (self.now,) + key)
+        return pickle.loads(bytes(row[0]))
+
+    def put(self, filename, acc):
+        data = sqlite3.Binary(pickle.dumps(acc, pickle.HIGHEST_PROTOCOL))
+        self.db.execute("INSERT OR REPLACE INTO partials VALUES (?, ?, ?, ?, ?, ?)",
+            self._key(filename, acc) + (data, self.now))
+
+    def evict(self):
+        total = 0
+        stale = []
+        for rowid, size in self.db.execute("SELECT rowid, length(data) FROM partials ORDER BY last_used DESC"):
+            total += size
+            if total > self.max_bytes:
+                stale.append((rowid,))
+        self.db.executemany("DELETE FROM partials WHERE rowid=?", stale)
+
+    def close(self):
+        self.evict()
+        self.db.commit()
+        self.db.close()
+
+class ProbeCache(object):
+    """SQLite cache of what was learned by probing the bro binary on a host
+
+    Entries are keyed by host, binary path and the binary's inode, mtime and
+    size, so replacing the binary invalidates them.  Entries unused for
+    PROBE_CACHE_DAYS are evicted.  Writes wait for close(), so that they
+    don't hold a lock on the file the PartialCache is writing to.
+    """
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename, timeout=60, check_same_thread=False)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS probes (
+            host TEXT, binary TEXT, stat TEXT, result TEXT, last_used REAL,
+            PRIMARY KEY (host, binary, stat))""")
+        self.now = time.time()
+        self.pending = []
+
+    def get(self, host, binary, stat):
+        key = (host, binary, stat)
+        where = "host=? AND binary=? AND stat=?"
+        row = self.db.execute("SELECT result FROM probes WHERE " + where, key).fetchone()
+        if row is None:
+            return None
+        self.pending.append(("UPDATE probes SET last_used=? WHERE " + where, (self.now,) + key))
+        return json.loads(row[0])
+
+    def put(self, host, binary, stat, result):
+        self.pending.append(("INSERT OR REPLACE INTO probes VALUES (?, ?, ?, ?, ?)",
+            (host, binary, stat, json.dumps(result), self.now)))
+
+    def close(self):
+        for sql, args in self.pending:
+            self.db.execute(sql, args)
+        self.db.execute("DELETE FROM probes WHERE last_used < ?", (self.now - PROBE_CACHE_DAYS * 86400,))
+        self.db.commit()
+        self.db.close()
+
+class GzipIndexCache(object):
+    """SQLite store of the GzipIndex of rotated logs, next to the cache
+
+    Like partials, an index is keyed by the path, size and mtime of its
+    file, and the least recently used are evicted once they grow beyond
+    GZINDEX_MAX_BYTES.  Like the ProbeCache, writes wait for close().
+    """
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename, timeout=60, check_same_thread=False)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS indexes (
+            path TEXT, size INTEGER, mtime REAL, data BLOB, last_used REAL,
+            PRIMARY KEY (path, size, mtime))""")
+        self.now = time.time()
+        self.pending = []
+
+    def _key(self, filename):
+        st = os.stat(filename)
+        return (filename, st.st_size, st.st_mtime)
+
+    def get(self, filename):
+        key = self._key(filename)
+        where = "path=? AND size=? AND mtime=?"
+        row = self.db.execute("SELECT data FROM indexes WHERE " + where, key).fetchone()
+        if row is None:
+            return None
+        self.pending.append(("UPDATE indexes SET last_used=? WHERE " + where, (self.now,) + key))
+        return pickle.loads(bytes(row[0]))
+
+    def put(self, filename, index):
+        data = sqlite3.Binary(pickle.dumps(index, pickle.HIGHEST_PROTOCOL))
+        self.pending.append(("INSERT OR REPLACE INTO indexes VALUES (?, ?, ?, ?, ?)",
+            self._key(filename) + (data, self.now)))
+
+    def close(self):
+        for sql, args in self.pending:
+            self.db.execute(sql, args)
+        total = 0
+        stale = []
+        for rowid, size in self.db.execute("SELECT rowid, length(data) FROM indexes ORDER BY last_used DESC"):
+            total += size
+            if total > GZINDEX_MAX_BYTES:
+                stale.append((rowid,))
+        self.db.executemany("DELETE FROM indexes WHERE rowid=?", stale)
+        self.db.commit()
+        self.db.close()
+
+class ListingCache(object):
+    """SQLite cache of the LogIndex listings of archived day directories
+
+    A listing is only used while its directory's mtime is unchanged.
+    Entries unused for LISTING_CACHE_DAYS are evicted.  Like the ProbeCache,
+    writes wait for close().
+    """
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename, timeout=60, check_same_thread=False)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS day_listings (
+            path TEXT PRIMARY KEY, mtime REAL, names TEXT, last_used REAL)""")
+        self.now = time.time()
+        self.pending = []
+
+    def get(self, path, mtime):
+        row = self.db.execute("SELECT names FROM day_listings WHERE path=? AND mtime=?", (path, mtime)).fetchone()
+        if row is None:
+            return None
+        self.pending.append(("UPDATE day_listings SET last_used=? WHERE path=?", (self.now, path)))
+        return json.loads(row[0])
+
+    def put(self, path, mtime, names):
+        self.pending.append(("INSERT OR REPLACE INTO day_listings VALUES (?, ?, ?, ?)",
+            (path, mtime, json.dumps(names), self.now)))
+
+    def close(self):
+        for sql, args in self.pending:
+            self.db.execute(sql, args)
+        self.db.execute("DELETE FROM day_listings WHERE last_used < ?", (self.now - LISTING_CACHE_DAYS * 86400,))
+        self.db.commit()
+        self.db.close()
+
+def split_probe_output(lines):
+    """Split the output of Doctor._probe_command into its stat, ldd and plugin parts"""
+    parts = [[]]
+    for line in lines:
+        if line.strip() == PROBE_MARK:
+            parts.append([])
+        else:
+            parts[-1].append(line)
+    parts += [[]] * (3 - len(parts))
+    return ''.join(parts[0]).strip(), parts[1], parts[2]
+
+def interface_devices(interface):
+    """Return the network devices a node's interface captures from, like eth0 for af_packet::eth0"""
+    devices = []
+    for intf in interface.split(","):
+        dev = intf.strip().rpartition("::")[2].partition("@")[0].rpartition(":")[2]
+        if dev:
+            devices.append(dev)
+    return devices
+
+def parse_load_output(lines):
+    """Parse the output of Doctor._load_command
+
+    Returns (samples, clock_ticks, cpus, affinity).  Each sample is a dict
+    of the uptime, {device: (packets, drops)} from /proc/net/dev, {device:
+    drops} from ethtool and {pid: CPU ticks used}.  cpus is the number of
+    CPUs online and affinity maps pids to the list of CPUs they may run on.
+    """
+    samples = []
+    clock_ticks = 100
+    cpus = 1
+    affinity = {}
+    for line in lines:
+        line = line.strip()
+        if line == LOAD_MARK:
+            samples.append({"uptime": None, "dev": {}, "nic": defaultdict(int), "cpu": {}})
+            continue
+        kind, _, rest = line.partition(" ")
+        try:
+            if kind == "clk_tck":
+                clock_ticks = int(rest)
+            elif kind == "cpus":
+                cpus = int(rest)
+            elif kind == "affinity":
+                pid, _, allowed = rest.partition(" ")
+                affinity[pid] = allowed.partition(":")[2].strip()
+            elif not samples:
+                continue
+            elif kind == "uptime":
+                samples[-1]["uptime"] = float(rest.split()[0])
+            elif kind == "dev" and ":" in rest:
+                name, _, counters = rest.partition(":")
+                # Receive bytes, packets, errs, drop, fifo, ...
+                c = counters.split()
+                samples[-1]["dev"][name.strip()] = (int(c[1]), int(c[3]) + int(c[4]))
+            elif kind == "stat":
+                pid, _, stat = rest.partition(" ")
+                # utime and stime, counting from the state after the (comm)
+                fields = stat.rpartition(")")[2].split()
+                if len(fields) > 12:
+                    samples[-1]["cpu"][pid] = int(fields[11]) + int(fields[12])
+            elif kind == "ethtool":
+                dev, _, stat = rest.partition(" ")
+                name, _, value = stat.partition(":")
+                if NIC_DROP_RE.search(name) and not name.strip().startswith("tx"):
+                    samples[-1]["nic"][dev] += int(value)
+        except (ValueError, IndexError):
+            continue
+    return samples, clock_ticks, cpus, affinity
+
+def is_local(rec):
+    return rec.local_orig in ('T', True) or rec.local_resp in ('T', True)
+
+class ProportionAccumulator(Accumulator):
+    """Accumulator for the percentage of counted records with a problem
+
+    Subclasses return (problems, counted) from counts().  Every
+    PROPORTION_STEP records the wilson_interval of that proportion is
+    checked, and reading stops once it is wholly above or below threshold
+    percent; a borderline result reads on up to limit.  With no limit every
+    record is read, as a --window asks.
+
+    Where to stop depends on every record before, so the partial of one
+    file can't be merged after others: these are only mergeable without a
+    limit, when they never stop early.
+    """
+    limit = PROPORTION_MAX_RECORDS
+    # Keeping the last limit lines of a compressed log would cost far more
+    # than the few thousand records that usually settle the verdict
+    recent = False
+    threshold = 1
+    version = 4
+
+    @property
+    def mergeable(self):
+        return self.limit is None
+
+    def counts(self):
+        raise NotImplementedError
+
+    def interval(self):
+        """Return the (low, high) percentages the true proportion is likely within"""
+        low, high = wilson_interval(*self.counts())
+        return 100 * low, 100 * high
+
+    def feed(self, rec):
+        super(ProportionAccumulator, self).feed(rec)
+        if self.done or self.limit is None or self.seen % PROPORTION_STEP:
+            return
+        low, high = wilson_interval(*self.counts())
+        self.done = not low <= self.threshold / 100.0 <= high
 
-    return recent_log_files
+class ConnLossAccumulator(ProportionAccumulator):
+    columns = ('proto', 'local_orig', 'local_resp', 'history', 'missed_bytes')
+    prefilter = ('proto', 'tcp')
+
+    def __init__(self):
+        super(ConnLossAccumulator, self).__init__()
+        self.loss = self.no_loss = 0
+
+    def add(self, rec):
+        # Ignore non tcp
+        if rec.proto != 'tcp':
+            return
+        # Ignore connections that don't even appear to be from our address space
+        if not is_local(rec):
+            return
+        # Ignore connections with no history
+        if rec.history is None:
+            return
+        #Ignore one packet connections
+        if history_flags(rec.history) & HISTORY_SINGLE_PACKET:
+            return
+        if rec.missed_bytes in ('0', 0):
+            self.no_loss += 1
+        else:
+            self.loss += 1
+
+    def counts(self):
+        return self.loss, self.loss + self.no_loss
+
+    def combine(self, other):
+        self.loss += other.loss
+        self.no_loss += other.no_loss
+
+def connection_tuple(rec):
+    """Return (tuple, node) for a connection worth checking for duplicates, or None"""
+    # Only count connections that have completed a three way handshake
+    # Also ignore flipped connections as those are probably backscatter
+    if rec.history is None or history_flags(rec.history) & (HISTORY_HANDSHAKE | HISTORY_FLIPPED) != HISTORY_HANDSHAKE:
+        return None
+    # Also ignore connections that didn't send bytes back and forth
+    if rec.orig_bytes in ('0', 0) or rec.resp_bytes in ('0', 0):
+        return None
+    tup = (rec.proto, rec.id_orig_h, rec.id_orig_p, rec.id_resp_h, rec.id_resp_p)
+    tup = ' '.join(str(f) for f in tup)
+    node = rec.node
+    if node is None:
+        node = "bro"
+    return tup, node
+
+def tuple_hashes(tup):
+    """Two 64 bit hashes of a connection tuple, the same in every process"""
+    return struct.unpack("<QQ", hashlib.md5(tup.encode('latin-1')).digest())
+
+class DuplicateTupleAccumulator(Accumulator):
+    """Count how often each connection tuple was logged, and by which nodes
+
+    Tuples are kept as 64 bit hashes mapped to the count in the low 32 bits
+    and a bitmask of node indexes above that.  The tuple text is only kept
+    once it has been seen twice, or always with keep_names.
+    With n tuples the chance of any hash collision is below n**2 / 2**65.
+
+    Partials merge by hash, so a tuple seen once in each of two files is a
+    duplicate without a name; complete() finds those with another pass over
+    the files.  Where that isn't possible the partials keep every name.
+    """
+    limit = 10000
+    columns = ('history', 'orig_bytes', 'resp_bytes', 'proto',
+               'id.orig_h', 'id.orig_p', 'id.resp_h', 'id.resp_p', NODE_COLUMN)
+    version = 3
+
+    def __init__(self, keep_names=False):
+        super(DuplicateTupleAccumulator, self).__init__()
+        self.tuples = {}
+        self.names = {}
+        self.nodes = []
+        self.node_index = {}
+        self.keep_names = keep_names
+
+    @classmethod
+    def from_options(cls, options):
+        if options.get("duplicate_sketch"):
+            return DuplicateSketchAccumulator(options["duplicate_sketch"] * 1024 * 1024)
+        return cls()
+
+    def self_contained_partial(self):
+        p = self.__class__(keep_names=True)
+        p.limit = self.limit
+        return p
+
+    def complete(self, filenames, jobs, since):
+        unnamed = [h for h, v in self.tuples.items()
+                   if h not in self.names and (self.keep_names or v & 0xffffffff > 1)]
+        if unnamed:
+            finder = TupleNameAccumulator(unnamed)
+            scan_logs(filenames, [finder], jobs, None, since)
+            self.names.update(finder.names)
+
+    def _node(self, name):
+        try:
+            return self.node_index[name]
+        except KeyError:
+            i = self.node_index[name] = len(self.nodes)
+            self.nodes.append(name)
+            return i
+
+    def _count(self, h, count, mask, tup):
+        v = self.tuples.get(h, 0)
+        total = (v & 0xffffffff) + count
+        self.tuples[h] = total | (v >> 32 | mask) << 32
+        if (total > 1 or self.keep_names) and tup is not None and h not in self.names:
+            self.names[h] = tup
+
+    def add(self, rec):
+        conn = connection_tuple(rec)
+        if conn is None:
+            return
+        tup, node = conn
+        self._count(tuple_hashes(tup)[0], 1, 1 << self._node(node), tup)
+
+    def combine(self, other):
+        remap = [self._node(n) for n in other.nodes]
+        for h, v in other.tuples.items():
+            mask = 0
+            other_mask = v >> 32
+            for i, j in enumerate(remap):
+                if other_mask & 1 << i:
+                    mask |= 1 << j
+            self._count(h, v & 0xffffffff, mask, other.names.get(h))
+
+    def distinct(self):
+        return len(self.tuples)
+
+    def duplicates(self):
+        """Return [(tuple, count, set of nodes)] for every tuple seen more than once, in the order first seen"""
+        dups = []
+        for h, v in self.tuples.items():
+            count = v & 0xffffffff
+            if count > 1:
+                mask = v >> 32
+                nodes = set(n for i, n in enumerate(self.nodes) if mask & 1 << i)
+                dups.append((self.names.get(h, "unknown tuple {:016x}".format(h)), count, nodes))
+        return dups
+
+    def duplicate_count(self):
+        return sum(1 for v in self.tuples.values() if v & 0xffffffff > 1)
+
+    def error_rate(self):
+        return 0.0
+
+class TupleNameAccumulator(Accumulator):
+    """Find the connection tuples with the given hashes, for DuplicateTupleAccumulator.complete"""
+    limit = None
+    columns = DuplicateTupleAccumulator.columns
+    cache_partials = False
+
+    def __init__(self, hashes=()):
+        super(TupleNameAccumulator, self).__init__()
+        self.hashes = set(hashes)
+        self.names = {}
+
+    def partial(self):
+        return self.__class__(self.hashes)
+
+    def add(self, rec):
+        conn = connection_tuple(rec)
+        if conn is None:
+            return
+        h = tuple_hashes(conn[0])[0]
+        if h in self.hashes and h not in self.names:
+            self.names[h] = conn[0]
+            self.done = len(self.names) == len(self.hashes)
+
+    def combine(self, other):
+        for h, tup in other.names.items():
+            self.names.setdefault(h, tup)
+        self.done = len(self.names) == len(self.hashes)
+
+class DuplicateSketchAccumulator(Accumulator):
+    """Approximate DuplicateTupleAccumulator in a fixed amount of memory
+
+    Tuples are counted in a counting Bloom filter of size one byte counters
+    using SKETCH_HASHES hashes.  A tuple seen for the first time is taken for
+    one seen before with probability error_rate(), the fraction of nonzero
+    counters to the power of SKETCH_HASHES, so the distinct and duplicate
+    counts are estimates within that error.  Only the first 20 duplicates are
+    kept in full, with the node of their first sighting taken from the last
+    node to touch their first counter.
+
+    Logs are read in order straight into the sketch, as it isn't mergeable.
+    Partials, for doctor watch and logger nodes, just keep the tuples they
+    saw, and combine() replays them in order.
+    """
+    limit = 10000
+    columns = DuplicateTupleAccumulator.columns
+    mergeable = False
+    cache_partials = False
+
+    def __init__(self, size=0):
+        super(DuplicateSketchAccumulator, self).__init__()
+        self.size = size
+        self.counters = bytearray(size)
+        self.first_nodes = bytearray(size)
+        self.nodes = []
+        self.node_index = {}
+        self.examples = {}
+        self.distinct_count = self.duplicate_total = 0
+        self.pending = []
+
+    def partial(self):
+        p = self.__class__()
+        p.limit = self.limit
+        return p
+
+    def _node(self, name):
+        try:
+            return self.node_index[name]
+        except KeyError:
+            i = self.node_index[name] = len(self.nodes)
+            self.nodes.append(name)
+            return i
+
+    def _insert(self, tup, node):
+        h1, h2 = tuple_hashes(tup)
+        cells = [(h1 + i * h2) % self.size for i in range(SKETCH_HASHES)]
+        counters = self.counters
+        seen = min(counters[c] for c in cells)
+        node_id = self._node(node)
+        if seen == 0:
+            self.distinct_count += 1
+        elif seen == 1:
+            self.duplicate_total += 1
+            if len(self.examples) < 20 and tup not in self.examples:
+                nodes = {node}
+                first = self.first_nodes[cells[0]]
+                if first:
+                    nodes.add(self.nodes[first - 1])
+                self.examples[tup] = [1, nodes]
+        if tup in self.examples:
+            ex = self.examples[tup]
+            ex[0] += 1
+            ex[1].add(node)
+        for c in cells:
+            if counters[c] < 255:
+                counters[c] += 1
+        if node_id < 255:
+            self.first_nodes[cells[0]] = node_id + 1
+
+    def add(self, rec):
+        conn = connection_tuple(rec)
+        if conn is None:
+            return
+        if self.size:
+            self._insert(*conn)
+        else:
+            self.pending.append(conn)
+
+    def combine(self, other):
+        for tup, node in other.pending:
+            self._insert(tup, node)
+
+    def distinct(self):
+        return self.distinct_count
+
+    def duplicates(self):
+        return [(tup, count, nodes) for tup, (count, nodes) in self.examples.items()]
+
+    def duplicate_count(self):
+        return self.duplicate_total
+
+    def error_rate(self):
+        if not self.size:
+            return 0.0
+        used = self.size - self.counters.count(b'\0')
+        return (float(used) / self.size) ** SKETCH_HASHES
+
+def _log_count(value):
+    """A count column as an int, 0 if unset"""
+    return int(value) if value not in (None, '-') else 0
+
+class DistributionAccumulator(Accumulator):
+    """Count the connections, packets and IP bytes of each node
+
+    The heaviest flows, by IP bytes between a pair of hosts on a port, are
+    kept in a SpaceSaving of HEAVY_FLOWS counters along with the bytes each
+    node logged for them.
+    """
+    limit = 10000
+    columns = (NODE_COLUMN, 'proto', 'id.orig_h', 'id.resp_h', 'id.resp_p',
+               'orig_pkts', 'orig_ip_bytes', 'resp_pkts', 'resp_ip_bytes')
+    version = 3
+
+    def __init__(self):
+        super(DistributionAccumulator, self).__init__()
+        self.nodes = defaultdict(int)
+        self.packets = defaultdict(int)
+        self.bytes = defaultdict(int)
+        # Values are {node: bytes}
+        self.flows = SpaceSaving(HEAVY_FLOWS)
+        self.missing_node_names = False
+
+    def add(self, rec):
+        node = rec.node
+        if node is None:
+            self.missing_node_names = True
+            self.done = True
+            return
+        self.nodes[node] += 1
+        self.packets[node] += _log_count(rec.orig_pkts) + _log_count(rec.resp_pkts)
+        octets = _log_count(rec.orig_ip_bytes) + _log_count(rec.resp_ip_bytes)
+        if octets:
+            self.bytes[node] += octets
+            flow = self.flows.add("{} {} {} {}".format(rec.proto, rec.id_orig_h, rec.id_resp_h, rec.id_resp_p), octets)
+            if flow[2] is None:
+                flow[2] = {}
+            flow[2][node] = flow[2].get(node, 0) + octets
+
+    @staticmethod
+    def _merge_flow_nodes(ours, theirs):
+        merged = dict(ours)
+        for node, octets in theirs.items():
+            merged[node] = merged.get(node, 0) + octets
+        return merged
+
+    def combine(self, other):
+        for node, cnt in other.nodes.items():
+            self.nodes[node] += cnt
+        for node, cnt in other.packets.items():
+            self.packets[node] += cnt
+        for node, cnt in other.bytes.items():
+            self.bytes[node] += cnt
+        self.flows.merge(other.flows, self._merge_flow_nodes)
+        self.missing_node_names = self.missing_node_names or other.missing_node_names
+
+    def heavy_flows(self):
+        """Return {node: [(flow, bytes, error)]} for the heaviest flows, largest first
+
+        Each flow is listed under the node that logged most of its bytes.
+        Only flows sure to outweigh every flow without a counter are listed:
+        when traffic is spread evenly their counts are mostly error.
+        """
+        floor = self.flows.floor()
+        by_node = defaultdict(list)
+        for flow, count, error, nodes in self.flows.top():
+            if count - error <= floor:
+                continue
+            node = max(nodes, key=lambda n: (nodes[n], n))
+            if len(by_node[node]) < HEAVY_FLOWS_SHOWN:
+                by_node[node].append((flow, count, error))
+        return by_node
+
+class SADAccumulator(ProportionAccumulator):
+    columns = ('history', 'proto', 'local_orig', 'local_resp')
+    prefilter = ('proto', 'tcp')
+
+    def __init__(self):
+        super(SADAccumulator, self).__init__()
+        self.ok = self.bad = 0
+
+    def add(self, rec):
+        # Ignore connections with no history
+        if rec.history is None:
+            return
+        # Ignore non tcp
+        if rec.proto != 'tcp':
+            return
+        # Ignore connections that don't even appear to be from our address space
+        if not is_local(rec):
+            return
+        flags = history_flags(rec.history)
+        #Ignore one packet connections
+        if flags & HISTORY_SINGLE_PACKET:
+            return
+        if flags & HISTORY_ONE_SIDED:
+            self.bad += 1
+        else:
+            self.ok += 1
+
+    def counts(self):
+        return self.bad, self.ok + self.bad
+
+    def combine(self, other):
+        self.ok += other.ok
+        self.bad += other.bad
+
+class LocalConnectionAccumulator(ProportionAccumulator):
+    columns = ('local_orig', 'local_resp')
+    threshold = 2
+
+    def __init__(self):
+        super(LocalConnectionAccumulator, self).__init__()
+        self.local = self.no_local = 0
+
+    def add(self, rec):
+        if is_local(rec):
+            self.local += 1
+        else:
+            self.no_local += 1
+
+    def counts(self):
+        return self.no_local, self.local + self.no_local
+
+    def combine(self, other):
+        self.local += other.local
+        self.no_local += other.no_local
+
+def relative_std_dev(values):
+    """Population standard deviation of values divided by their mean"""
+    if numpy is not None:
+        a = numpy.asarray(values, dtype=numpy.float64)
+        return float(a.std() / a.mean())
+    mean = float(sum(values)) / len(values)
+    return sqrt(sum((v - mean) ** 2 for v in values) / len(values)) / mean
+
+class LossStats(object):
+    """The loss percentages one worker reported, and its total gaps and acks
+
+    Percentages are kept in a typed array, 8 bytes each, and summarized in
+    one pass over a sorted copy.
+    """
+    __slots__ = ('losses', 'gaps', 'acks')
+
+    def __init__(self):
+        self.losses = array('d')
+        self.gaps = self.acks = 0
+
+    def add(self, percent_lost, gaps, acks):
+        self.losses.append(percent_lost)
+        self.gaps += gaps
+        self.acks += acks
+
+    def combine(self, other):
+        self.losses.extend(other.losses)
+        self.gaps += other.gaps
+        self.acks += other.acks
+
+    def summary(self):
+        """Return (count, loss_count, min_loss, max_loss, [percentile for each LOSS_PERCENTILES])
+
+        Percentiles are nearest rank, so always one of the reported values.
+        """
+        if numpy is not None:
+            losses = numpy.sort(numpy.frombuffer(self.losses, dtype=numpy.float64))
+            loss_count = int(numpy.count_nonzero(losses))
+        else:
+            losses = sorted(self.losses)
+            loss_count = len(losses) - (bisect_right(losses, 0.0) - bisect_left(losses, 0.0))
+        n = len(losses)
+        pcts = [float(losses[max(int(ceil(p * n / 100.0)) - 1, 0)]) for p in LOSS_PERCENTILES]
+        return n, loss_count, float(losses[0]), float(losses[-1]), pcts
+
+    def __getstate__(self):
+        return [getattr(self, k) for k in self.__slots__]
+
+    def __setstate__(self, state):
+        for k, v in zip(self.__slots__, state):
+            setattr(self, k, v)
+
+class CaptureLossAccumulator(Accumulator):
+    limit = 10000
+    columns = ('peer', 'percent_lost', 'gaps', 'acks')
+    version = 3
+
+    def __init__(self):
+        super(CaptureLossAccumulator, self).__init__()
+        self.workers = defaultdict(LossStats)
+
+    def add(self, rec):
+        self.workers[rec.peer].add(float(rec.percent_lost), int(rec.gaps), int(rec.acks))
+
+    def combine(self, other):
+        for w, stats in other.workers.items():
+            self.workers[w].combine(stats)
+
+_template_masks = [
+    (re.compile(r"\b\d{4}-\d\d-\d\d[T ]\d\d:\d\d:\d\d(?:\.\d+)?Z?"), "<time>"),
+    (re.compile(r"\b\d{1,3}(?:\.\d{1,3}){3}\b|(?<![\w:])(?:[0-9a-fA-F]{0,4}:){2,7}[0-9a-fA-F]{0,4}(?![\w:])"), "<addr>"),
+    # Connection and file uids
+    (re.compile(r"\b[CF](?=[0-9A-Za-z]*\d)[0-9A-Za-z]{14,18}\b"), "<uid>"),
+    (re.compile(r"\b0x[0-9a-fA-F]+\b|\b\d+(?:\.\d+)?\b"), "<num>"),
+]
+def message_template(message):
+    """Return message with its times, addresses, uids and numbers masked"""
+    for pattern, mask in _template_masks:
+        message = pattern.sub(mask, message)
+    return message
+
+def _reporter_line(rec):
+    location = rec.location if rec.location not in (None, '-', '(empty)') else ''
+    ts = rec.ts if rec.ts != '0.000000' else ''
+    return "{} {} {} {}".format(location, ts, rec.level, rec.message).lstrip()
+
+def _reporter_time(ts):
+    try:
+        return parse_ts(ts)
+    except ValueError:
+        return 0.0
+
+class ReporterAccumulator(Accumulator):
+    """Count reporter messages by level and by template, see message_template
+
+    The REPORTER_TEMPLATES most common templates are kept in a SpaceSaving,
+    with the earliest and latest message of each as examples, so reading
+    every message of a flood takes constant memory.
+    """
+    limit = None
+    columns = ('ts', 'level', 'message', 'location')
+    version = 3
+
+    def __init__(self):
+        super(ReporterAccumulator, self).__init__()
+        self.levels = defaultdict(int)
+        # Values are [first ts, first message, last ts, last message]
+        self.templates = SpaceSaving(REPORTER_TEMPLATES)
+
+    def add(self, rec):
+        self.levels[rec.level] += 1
+        ts = _reporter_time(rec.ts)
+        examples = self.templates.add((rec.level, message_template(rec.message)))
+        if examples[2] is None:
+            line = _reporter_line(rec)
+            examples[2] = [ts, line, ts, line]
+        elif ts < examples[2][0]:
+            examples[2][:2] = ts, _reporter_line(rec)
+        elif ts >= examples[2][2]:
+            examples[2][2:] = ts, _reporter_line(rec)
+
+    @staticmethod
+    def _merge_examples(ours, theirs):
+        return min(ours[:2], theirs[:2]) + max(ours[2:], theirs[2:])
+
+    def combine(self, other):
+        for level, cnt in other.levels.items():
+            self.levels[level] += cnt
+        self.templates.merge(other.templates, self._merge_examples)
+
+# Checks that only need a single pass over recent conn logs
+CONN_ACCUMULATORS = {
+    "check_capture_loss_conn_pct": ConnLossAccumulator,
+    "check_duplicate_5_tuples": DuplicateTupleAccumulator,
+    "check_connection_distribution": DistributionAccumulator,
+    "check_SAD_connections": SADAccumulator,
+    "check_local_connections": LocalConnectionAccumulator,
+}
+
+# Checks doctor watch can follow, by the log in current/ they read
+WATCH_LOGS = {
+    "conn": CONN_ACCUMULATORS,
+    "capture_loss": {"check_capture_loss": CaptureLossAccumulator},
+    "reporter": {"check_reporter": ReporterAccumulator},
+}
+
+# Checks that share state are run one after another by the same worker when
+# the checks run concurrently, see Doctor._start_checks
+CHECK_GROUPS = dict([(name, "logs") for log in WATCH_LOGS.values() for name in log],
+    check_pfring="probe", check_malloc="probe")
+
+def collect_accumulators(logdir, checks, options, now):
+    """Scan the recent logs in logdir for the WATCH_LOGS checks in checks
+
+    Returns {check: partial accumulator}, read as the checks themselves
+    would with options.  This is what each logger node runs for --loggers.
+    """
+    since = now - options["window"] if options["window"] is not None else None
+    collected = {}
+    for log, accumulators in WATCH_LOGS.items():
+        names = [name for name in accumulators if name in checks]
+        if not names:
+            continue
+        for name in names:
+            acc = accumulators[name].from_options(options)
+            if since is not None:
+                acc.limit = None
+            collected[name] = acc.self_contained_partial()
+        files = find_recent_log_files(logdir, log + ".*", 1 if log == "conn" else GOBACK, since)
+        accumulators = [collected[name] for name in names]
+        if not (log == "conn" and options["sample"] and sample_logs(files, accumulators, None, since)):
+            scan_logs(reversed(files), accumulators, options["jobs"], None, since)
+    return collected
+
+def print_partials(args):
+    """Entry point for "python doctor.py partials LOGDIR [options] [check]..."
+
+    Prints PARTIALS_MARK and then the collected accumulators, pickled,
+    compressed and base64 encoded.
+    """
+    checks, options = parse_args(args[1:])
+    collected = collect_accumulators(args[0], checks, options, time.time())
+    print(PARTIALS_MARK)
+    print(base64.b64encode(zlib.compress(pickle.dumps(collected, 2))).decode('ascii'))
+    return 0
+
+class PartialsUnpickler(pickle.Unpickler):
+    """Load the output of print_partials, which pickles the accumulators as __main__ ones
+
+    Classes are looked up here whatever module they were pickled from, and
+    only the accumulators and the few standard types they hold are allowed.
+    """
+    ALLOWED = set([
+        ("collections", "defaultdict"), ("collections", "deque"),
+        ("array", "array"), ("array", "_array_reconstructor"),
+        ("copy_reg", "_reconstructor"), ("copyreg", "_reconstructor"),
+        ("__builtin__", "object"), ("builtins", "object"),
+        ("__builtin__", "int"), ("__builtin__", "long"), ("builtins", "int"),
+        ("__builtin__", "set"), ("builtins", "set"),
+        ("__builtin__", "bytearray"), ("builtins", "bytearray"),
+        ("_codecs", "encode"),
+    ])
+
+    def find_class(self, module, name):
+        cls = globals().get(name)
+        if isinstance(cls, type) and (issubclass(cls, Accumulator) or cls in (LossStats, SpaceSaving)):
+            return cls
+        if (module, name) in self.ALLOWED:
+            return pickle.Unpickler.find_class(self, module, name)
+        raise pickle.UnpicklingError("{}.{} is not allowed in collected partials".format(module, name))
+
+def parse_args(args):
+    """Split cmd_custom arguments into check names and a dict of OPTIONS
+
+    Options are given as --name value or --name=value, flags as just --name.
+    """
+    checks = []
+    options = dict((k, v[0]) for k, v in OPTIONS.items())
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if not arg.startswith("--"):
+            checks.append(arg)
+            continue
+        name, eq, value = arg[2:].partition("=")
+        name = name.replace("-", "_")
+        if name not in OPTIONS:
+            raise ValueError("Unknown option {}".format(arg))
+        default, convert = OPTIONS[name]
+        if convert is None:
+            options[name] = True
+            continue
+        if not eq:
+            if not args:
+                raise ValueError("Option {} needs a value".format(arg))
+            value = args.pop(0)
+        try:
+            options[name] = convert(value)
+        except ValueError:
+            raise ValueError("Invalid value for {}: {!r}".format(arg, value))
+    return checks, options
 
 def split_doc(txt):
     """Split a docstring into a first line + rest blurb"""
@@ -177,9 +2471,89 @@ def split_doc(txt):
     rest = textwrap.dedent(rest.rstrip())
     return short, rest
 
+class StandalonePlugin(object):
+    """Just enough of PluginBase.Plugin to run the checks outside of broctl
+
+    Global options come from the global_options dict and nodes from
+    node_list, like StandaloneNode.  Remote commands are run on this host.
+    """
+    def __init__(self, apiversion):
+        self.global_options = {}
+        self.node_list = []
+
+    def message(self, msg):
+        print(msg)
+
+    def error(self, msg):
+        print(msg, file=sys.stderr)
+
+    def debug(self, msg):
+        pass
+
+    def getGlobalOption(self, name):
+        return self.global_options.get(name, "")
+
+    def nodes(self):
+        return self.node_list
+
+    def executeParallel(self, cmds):
+        procs = [(node, subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE))
+                 for node, cmd in cmds]
+        results = []
+        for node, proc in procs:
+            out, err = proc.communicate()
+            lines = out.decode('latin-1').splitlines()
+            # The error output of a failed command ends its output, where the
+            # checks report it from
+            if proc.returncode != 0:
+                lines += err.decode('latin-1').splitlines()
+            results.append((node, proc.returncode == 0, lines))
+        return results
+
+class StandaloneNode(object):
+    """A node for StandalonePlugin.node_list, with what the checks use of a broctl node"""
+    def __init__(self, name, host="localhost", type="worker", interface=None, pid=None, lb_method=None):
+        self.name = name
+        self.host = host
+        self.type = type
+        self.interface = interface
+        self.pid = pid
+        self.lb_method = lb_method
+
+    def getPID(self):
+        return self.pid
+
+    def __str__(self):
+        return self.name
+
+class StandaloneCmdResult(object):
+    ok = True
+
+if PluginBase is None:
+    class PluginBase(object):
+        Plugin = StandalonePlugin
+    class cmdresult(object):
+        CmdResult = StandaloneCmdResult
+
 class Doctor(PluginBase.Plugin):
     def __init__(self):
         super(Doctor, self).__init__(apiversion=1)
+        self._selected_checks = set()
+        self._conn_accumulators = None
+        # Accumulators for each check gathered by doctor watch or from the
+        # logger nodes, instead of scanning the logs here
+        self._collected = None
+        self._options = dict((k, v[0]) for k, v in OPTIONS.items())
+        self._cache = None
+        self._probe_cache = None
+        self._listing_cache = None
+        self._index_cache = None
+        self._probes = None
+        self._now = time.time()
+        # Messages of the check running on each thread, buffered while
+        # checks run concurrently
+        self._output = threading.local()
+        self._execute_lock = threading.Lock()
 
     def name(self):
         return "doctor"
@@ -191,11 +2565,27 @@ class Doctor(PluginBase.Plugin):
         self.log_directory = self.getGlobalOption("logdir")
         self.bro_binary = self.getGlobalOption(BINARY)
         self.bro_site = self.getGlobalOption("sitepolicypath")
+        self.cache_file = os.path.join(self.getGlobalOption("spooldir"), "doctor-cache.sqlite")
+        self.index_file = os.path.join(self.getGlobalOption("spooldir"), "doctor-gzindex.sqlite")
         return True
 
     def commands(self):
         return [("", "", "Troubleshoot Bro installation")]
 
+    def message(self, msg):
+        lines = getattr(self._output, "lines", None)
+        if lines is None:
+            super(Doctor, self).message(msg)
+        else:
+            lines.append((False, msg))
+
+    def error(self, msg):
+        lines = getattr(self._output, "lines", None)
+        if lines is None:
+            super(Doctor, self).error(msg)
+        else:
+            lines.append((True, msg))
+
     def err(self, msg):
         self.error(red(msg))
 
@@ -208,56 +2598,354 @@ class Doctor(PluginBase.Plugin):
             self.err(msg)
         return is_ok
 
-    def _ldd_bro(self):
-        cmds = []
-        ldd_cmd = "ldd {0} 2>/dev/null || otool -L {0} 2>/dev/null".format(self.bro_binary)
-        interface_nodes = set(n for n in self.nodes() if n.interface)
-        for n in interface_nodes:
-            cmds.append((n, ldd_cmd))
+    def _stat_command(self):
+        return "(stat -L -c '%i %Y %s' {0} || stat -L -f '%i %m %z' {0}) 2>/dev/null".format(self.bro_binary)
+
+    def _probe_command(self):
+        return "; ".join([
+            self._stat_command(),
+            "echo " + PROBE_MARK,
+            "ldd {0} 2>/dev/null || otool -L {0} 2>/dev/null",
+            "echo " + PROBE_MARK,
+            "{0} -N",
+        ]).format(self.bro_binary)
+
+    def _load_command(self, pids, devices):
+        """Return the command that samples the drops of devices and the CPU use of pids twice"""
+        sample = ["echo " + LOAD_MARK, "echo uptime $(cat /proc/uptime)", "sed 's/^/dev /' /proc/net/dev"]
+        sample += ["echo stat {0} $(cat /proc/{0}/stat 2>/dev/null)".format(pid) for pid in pids]
+        sample += ["ethtool -S {0} 2>/dev/null | sed 's/^/ethtool {0} /'".format(quote(dev)) for dev in devices]
+        sample = "; ".join(sample)
+        return "; ".join(["echo clk_tck $(getconf CLK_TCK)", "echo cpus $(getconf _NPROCESSORS_ONLN)"] +
+            ["echo affinity {0} $(grep Cpus_allowed_list /proc/{0}/status 2>/dev/null)".format(pid) for pid in pids] +
+            [sample, "sleep {}".format(LOAD_SAMPLE_SECONDS), sample])
+
+    def _probe_bro(self):
+        """Return {host: [success, ldd output, plugin list]} for hosts with interface nodes
+
+        One node per host runs a single command that stats the binary, runs
+        ldd on it and lists its plugins.  Results are kept for the rest of
+        the run, and in the ProbeCache across runs; with a cache, a cheap stat
+        of the binary on every host comes first to find what is still valid.
+        """
+        if self._probes is not None:
+            return self._probes
+
+        hosts = {}
+        for n in self.nodes():
+            if n.interface:
+                hosts.setdefault(n.host, n)
+        probes = {}
+        todo = list(hosts.values())
+        cache = self._probe_cache
+        if cache and todo:
+            todo = []
+            for n, success, output in self._execute([(n, self._stat_command()) for n in hosts.values()]):
+                result = cache.get(n.host, self.bro_binary, ''.join(output).strip())
+                if result is None:
+                    todo.append(n)
+                else:
+                    probes[n.host] = result
+
+        if todo:
+            for n, success, output in self._execute([(n, self._probe_command()) for n in todo]):
+                stat, ldd, plugins = split_probe_output(output)
+                probes[n.host] = [success, ldd, plugins]
+                if cache and stat:
+                    cache.put(n.host, self.bro_binary, stat, probes[n.host])
+
+        self._probes = probes
+        return probes
 
-        return self.executeParallel(cmds)
+    def _ldd_bro(self):
+        probes = self._probe_bro()
+        return [(n, probes[n.host][0], probes[n.host][1]) for n in self.nodes() if n.interface]
 
     def _list_plugins(self):
-        cmds = []
-        ldd_cmd = "{0} -N".format(self.bro_binary)
-        interface_nodes = set(n for n in self.nodes() if n.interface)
-        for n in interface_nodes:
-            cmds.append((n, ldd_cmd))
+        probes = self._probe_bro()
+        return [(n, probes[n.host][0], probes[n.host][2]) for n in self.nodes() if n.interface]
+
+    def _open_cache(self, cls, filename=None):
+        if self._options["no_cache"]:
+            return None
+        filename = filename or self.cache_file
+        try:
+            return cls(filename)
+        except (sqlite3.Error, OSError, IOError) as e:
+            self.message("warning: not using cache {}: {}".format(filename, e))
+            return None
+
+    def _open_caches(self):
+        self._cache = self._open_cache(PartialCache)
+        self._probe_cache = self._open_cache(ProbeCache)
+        self._listing_cache = self._open_cache(ListingCache)
+        log_index(self.log_directory, self._listing_cache)
+        if self._options["sample"]:
+            self._index_cache = self._open_cache(GzipIndexCache, self.index_file)
+
+    def _close_caches(self):
+        for cache in self._cache, self._probe_cache, self._listing_cache, self._index_cache:
+            if cache:
+                cache.close()
+        self._cache = self._probe_cache = self._listing_cache = self._index_cache = None
+
+    def _run_check(self, func):
+        """Run the check func on this thread, returning (ok, its buffered output)"""
+        self._output.lines = output = []
+        try:
+            ok = getattr(self, func)()
+        except Exception:
+            ok = False
+            self.error(traceback.format_exc())
+        finally:
+            self._output.lines = None
+        return ok, output
+
+    def _replay(self, output):
+        for is_error, msg in output:
+            if is_error:
+                self.error(msg)
+            else:
+                self.message(msg)
+
+    def _start_checks(self, checks):
+        """Start running checks concurrently and open the caches
+
+        The checks of a CHECK_GROUPS group run one after another in the same
+        worker, every other check on its own.  The log checks are CPU bound
+        and run in a forked process, which opens its own caches, unless
+        --loggers has them waiting on the logger nodes; the rest run on
+        threads.  Returns {check: wait}, where wait() blocks until the check
+        has run and returns (ok, its buffered output).
+        """
+        groups = {}
+        for func in checks:
+            groups.setdefault(CHECK_GROUPS.get(func, func), []).append(func)
+        waits = {}
+        if "logs" in groups and not self._options["loggers"]:
+            # Fork before opening our caches, their connections can't be shared
+            waits.update(self._start_process(groups.pop("logs")))
+        self._open_caches()
+        for funcs in groups.values():
+            waits.update(self._start_thread(funcs))
+        return waits
+
+    def _start_thread(self, funcs):
+        results = {}
+        done = dict((func, threading.Event()) for func in funcs)
+        def run():
+            for func in funcs:
+                results[func] = self._run_check(func)
+                done[func].set()
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        def waiter(func):
+            def wait():
+                done[func].wait()
+                return results[func]
+            return wait
+        return dict((func, waiter(func)) for func in funcs)
+
+    def _start_process(self, funcs):
+        receiver, sender = multiprocessing.Pipe(False)
+        context = fork_context()
+        process = context.Process(target=self._check_process, args=(funcs, sender))
+        process.start()
+        sender.close()
+        results = {}
+        def waiter(func):
+            def wait():
+                while func not in results:
+                    try:
+                        name, ok, output, stats = receiver.recv()
+                    except EOFError:
+                        process.join()
+                        msg = "The process running the log checks exited with status {}".format(process.exitcode)
+                        for name in funcs:
+                            results.setdefault(name, (False, [(True, red(msg))]))
+                        break
+                    results[name] = ok, output
+                    for k, v in stats.items():
+                        io_stats[k] += v
+                if len(results) == len(funcs) and process.is_alive():
+                    process.join()
+                return results[func]
+            return wait
+        return dict((func, waiter(func)) for func in funcs)
+
+    def _check_process(self, funcs, sender):
+        """Run funcs in a forked process, sending (check, ok, output, io_stats) for each"""
+        self._open_caches()
+        try:
+            for func in funcs:
+                before = dict(io_stats)
+                ok, output = self._run_check(func)
+                stats = dict((k, v - before.get(k, 0)) for k, v in io_stats.items())
+                sender.send((func, ok, output, stats))
+        finally:
+            self._close_caches()
+            sender.close()
+
+    def _since(self):
+        if self._options["window"] is None:
+            return None
+        return self._now - self._options["window"]
+
+    def _find_logs(self, glob_pattern, days):
+        """find_recent_log_files for the last days, or the --window if one was given"""
+        return find_recent_log_files(self.log_directory, glob_pattern, days, self._since())
+
+    def _log_span(self, days):
+        """Describe the span _find_logs looked at, for messages"""
+        if self._options["window"] is None:
+            return "in the past {} days".format(days)
+        return "in the last {}".format(format_duration(self._options["window"]))
+
+    def _accumulator(self, cls):
+        acc = cls.from_options(self._options)
+        # A --window replaces the record limits
+        if self._options["window"] is not None:
+            acc.limit = None
+        return acc
+
+    def _scan_logs(self, files, accumulators):
+        scan_logs(files, accumulators, self._options["jobs"], self._cache, self._since())
+
+    def _sample_logs(self, files, accumulators):
+        """sample_logs, or False after a warning if the logs can't be sampled"""
+        if sample_logs(files, accumulators, self._index_cache, self._since()):
+            return True
+        self.message("warning: --sample needs plain or gzip logs and the zlib library, reading the latest records")
+        return False
+
+    def _execute(self, cmds):
+        """executeParallel, timed for --profile, and one at a time across threads"""
+        with self._execute_lock:
+            start = time.time()
+            results = self.executeParallel(cmds)
+            io_stats["remote_commands"] += len(cmds)
+            io_stats["remote_seconds"] += time.time() - start
+        return results
 
-        return self.executeParallel(cmds)
+    def _collect_command(self, checks):
+        script = re.sub(r"\.py[co]$", ".py", os.path.abspath(__file__))
+        args = [self.log_directory]
+        for name in "jobs", "duplicate_sketch", "window":
+            if self._options[name] != OPTIONS[name][0]:
+                args += ["--" + name.replace("_", "-"), str(self._options[name])]
+        if self._options["sample"]:
+            args.append("--sample")
+        return "$(command -v python3 || command -v python) {} partials {}".format(
+            quote(script), " ".join(quote(a) for a in args + sorted(checks)))
+
+    def _collect_from_loggers(self):
+        """Return {check: accumulator} merged from the logs on every logger host
+
+        Each host runs collect_accumulators on its own logs, through a copy
+        of this file at the same path, and sends back only the results.
+        """
+        checks = set(name for log in WATCH_LOGS.values() for name in log) & self._selected_checks
+        hosts = {}
+        for n in self.nodes():
+            if n.type == "logger":
+                hosts.setdefault(n.host, n)
+        if not hosts:
+            self.message("warning: no logger nodes, reading the logs in {}".format(self.log_directory))
+            return {}
+
+        collected = {}
+        for name in checks:
+            for log in WATCH_LOGS.values():
+                if name in log:
+                    collected[name] = self._accumulator(log[name])
+                    collected[name].limit = None
+        command = self._collect_command(checks)
+        for n, success, output in self._execute([(n, command) for n in hosts.values()]):
+            lines = [line.strip() for line in output]
+            if not success or PARTIALS_MARK not in lines:
+                self.err("Could not read the logs on {}: {}".format(n.host, " ".join(lines[-3:])))
+                continue
+            data = "".join(lines[lines.index(PARTIALS_MARK) + 1:])
+            try:
+                partials = PartialsUnpickler(io.BytesIO(zlib.decompress(base64.b64decode(data)))).load()
+            except Exception as e:
+                self.err("Could not load the results from {}: {}".format(n.host, e))
+                continue
+            for name, partial in partials.items():
+                collected[name].merge(partial)
+        return collected
+
+    def _collected_accumulator(self, check):
+        """Return the accumulator for check from doctor watch or the logger nodes
+
+        None means the check should read the logs here.
+        """
+        if self._collected is None and self._options["loggers"]:
+            self._collected = self._collect_from_loggers()
+        if self._collected is None:
+            return None
+        return self._collected.get(check)
+
+    def _conn_scan(self, check):
+        """Return the accumulator for check after a shared pass over recent conn logs
+
+        The first conn check to run reads the logs once for every selected conn
+        check.  Returns None if there are no conn logs.
+        """
+        acc = self._collected_accumulator(check)
+        if acc is None:
+            if self._conn_accumulators is None or check not in self._conn_accumulators:
+                files = self._find_logs("conn.*", days=1)
+                if not files:
+                    return None
+                checks = (self._selected_checks & set(CONN_ACCUMULATORS)) | {check}
+                self._conn_accumulators = dict((name, self._accumulator(CONN_ACCUMULATORS[name])) for name in checks)
+                accumulators = list(self._conn_accumulators.values())
+                if not (self._options["sample"] and self._sample_logs(files, accumulators)):
+                    self._scan_logs(reversed(files), accumulators)
+            acc = self._conn_accumulators[check]
+        elif not acc.seen:
+            return None
+        if acc.failure:
+            raise Exception(acc.failure)
+        io_stats["records_used"] += acc.seen
+        return acc
 
     def check_reporter(self):
         """Checking for recent reporter.log entries
         
         If bro is running well, there will be zero reporter.log messages.
+        Messages that only differ in addresses, numbers, times or uids are
+        counted together, and the most common are shown with their first and
+        latest occurrence.
         """
-        files = find_recent_log_files(self.log_directory, "reporter.*", days=GOBACK)
-        if not files:
-            self.message("No reporter log files in the past {} days".format(GOBACK) )
+        acc = self._collected_accumulator("check_reporter")
+        if acc is None:
+            files = self._find_logs("reporter.*", days=GOBACK)
+            if not files:
+                self.message("No reporter log files {}".format(self._log_span(GOBACK)))
+                return True
+            self.err("Found {} reporter log files {}".format(len(files), self._log_span(GOBACK)))
+            acc = self._accumulator(ReporterAccumulator)
+            self._scan_logs(reversed(files), [acc])
+        if acc.failure:
+            raise Exception(acc.failure)
+        io_stats["records_used"] += acc.seen
+        if not acc.seen:
+            self.message("No reporter log messages")
             return True
-        self.err("Found {} reporter log files in the past {} days".format(len(files), GOBACK) )
-
-        self.message("Recent reporter.log messages:")
-        seen = defaultdict(list)
-        order = []
-        for rec in read_bro_logs_with_line_limit(reversed(files), 1000):
-            if rec['ts'] == '0.000000':
-                rec['ts'] = ''
-            if rec['location'] == '(empty)':
-                rec['location'] = ''
-            m = "{location} {ts} {level} {message}".format(**rec).lstrip()
-            key = "{level} {message}".format(**rec).lstrip()
-            if key not in seen:
-                order.append(key)
-            seen[key].append(m)
-
-        for key in order:
-            msgs = seen[key]
-            count = len(msgs)
-            for m in msgs[:2]:
-                self.message(red(m))
-            if len(msgs) > 2:
-                self.message("{} duplicate messages suppressed".format(len(msgs)-2))
+
+        levels = ", ".join("{} {}".format(cnt, level) for level, cnt in sorted(acc.levels.items()))
+        templates = acc.templates.top()
+        self.message("{} reporter.log messages ({}) of {}{} kinds, the most common:".format(
+            acc.seen, levels, len(templates), "+" if acc.templates.floor() else ""))
+        for (level, template), count, error, (first_ts, first, last_ts, last) in templates[:REPORTER_SHOWN]:
+            self.message("{}{} times: {} {}".format("up to " if error else "", count, level, template))
+            for m in [first] if first == last else [first, last]:
+                self.message(red("    " + m))
+        if len(templates) > REPORTER_SHOWN:
+            self.message("{} less common kinds of messages not shown".format(len(templates) - REPORTER_SHOWN))
         return False
 
     def check_capture_loss(self):
@@ -265,29 +2953,34 @@ class Doctor(PluginBase.Plugin):
         
         Capture loss should be as low as possible across all workers.
         """
-        files = find_recent_log_files(self.log_directory, "capture_loss.*", days=GOBACK)
-        if not files:
-            self.err("No capture_loss log files in the past {} days".format(GOBACK) )
-            self.err("Add '@load misc/capture-loss' to your local.bro")
-            return False
+        acc = self._collected_accumulator("check_capture_loss")
+        if acc is not None:
+            if not acc.seen:
+                self.err("No capture_loss log records")
+                return False
+        else:
+            files = self._find_logs("capture_loss.*", days=GOBACK)
+            if not files:
+                self.err("No capture_loss log files {}".format(self._log_span(GOBACK)))
+                self.err("Add '@load misc/capture-loss' to your local.bro")
+                return False
 
-        workers = defaultdict(list)
-        for rec in read_bro_logs_with_line_limit(reversed(files), 10000):
-            workers[rec['peer']].append(rec)
+            acc = self._accumulator(CaptureLossAccumulator)
+            self._scan_logs(reversed(files), [acc])
+        if acc.failure:
+            raise Exception(acc.failure)
+        io_stats["records_used"] += acc.seen
 
         self.message("Capture loss stats:")
         
         ok = True
-        for w, recs in sorted(workers.items()):
-            min_loss = min(float(rec['percent_lost']) for rec in recs)
-            max_loss = max(float(rec['percent_lost']) for rec in recs)
-            total_gaps = sum(int(rec['gaps']) for rec in recs)
-            total_acks = sum(int(rec['acks']) for rec in recs)
-            overall_pct = percent(total_gaps, total_acks)
-            loss_count = sum(1 for rec in recs if float(rec['percent_lost']) != 0.0)
-            noloss_count = len(recs) - loss_count
+        for w, stats in sorted(acc.workers.items()):
+            overall_pct = percent(stats.gaps, stats.acks)
+            count, loss_count, min_loss, max_loss, pcts = stats.summary()
+            noloss_count = count - loss_count
 
             msg = "worker={} loss_count={} noloss_count={} min_loss={} max_loss={} overall_loss={}".format(w, loss_count, noloss_count, min_loss, max_loss, overall_pct)
+            msg += "".join(" p{}={}".format(p, v) for p, v in zip(LOSS_PERCENTILES, pcts))
             ok = self.ok_if(msg, overall_pct <= LOSS_THRESHOLD) and ok
         return ok
 
@@ -298,35 +2991,16 @@ class Doctor(PluginBase.Plugin):
         report on the percentage of recent connections show any loss at all.
         """
 
-        files = find_recent_log_files(self.log_directory, "conn.*", days=1)
-        if not files:
+        acc = self._conn_scan("check_capture_loss_conn_pct")
+        if acc is None:
             self.err("No conn log files in the past day???")
             return False
 
-        loss = no_loss = 0
-        for rec in read_bro_logs_with_line_limit(reversed(files), 100000):
-            # Ignore non tcp
-            if rec['proto'] != 'tcp':
-                continue
-            # Ignore connections that don't even appear to be from our address space
-            if rec['local_orig'] not in ('T', True) and rec['local_resp'] not in ('T', True):
-                continue
-            # Ignore connections with no history
-            if 'history' not in rec:
-                continue
-            h = rec['history'].replace("^", "")
-            #Ignore one packet connections
-            if len(h) == 1:
-                continue
-            if rec['missed_bytes'] in ('0', 0):
-                no_loss += 1
-            else:
-                loss += 1
-
-        total = loss + no_loss
+        loss, total = acc.counts()
         pct = percent(loss, total)
-        msg = "{:.2f}%, {} out of {} connections have capture loss".format(pct, loss, total)
-        return self.ok_if(msg, pct <= 1)
+        low, high = acc.interval()
+        msg = "{:.2f}% ({:.2f}% to {:.2f}%), {} out of {} connections have capture loss".format(pct, low, high, loss, total)
+        return self.ok_if(msg, pct <= acc.threshold)
 
     def check_pfring(self):
         """Checking pf_ring configuration
@@ -389,33 +3063,20 @@ class Doctor(PluginBase.Plugin):
         especially once per worker, load balancing is not working properly.
         """
 
-        files = find_recent_log_files(self.log_directory, "conn.*", days=1)
-        if not files:
+        acc = self._conn_scan("check_duplicate_5_tuples")
+        if acc is None:
             self.err("No conn log files in the past day???")
             return False
 
-        tuples = defaultdict(list)
-        for rec in read_bro_logs_with_line_limit(reversed(files), 10000):
-            # Only count connections that have completed a three way handshake
-            # Also ignore flipped connections as those are probably backscatter
-            if 'history' not in rec or 'h' not in rec['history'].lower() or '^' in rec['history']:
-                continue
-            # Also ignore connections that didn't send bytes back and forth
-            if rec.get('orig_bytes') in ('0', 0) or rec.get('resp_bytes') in ('0', 0):
-                continue
-            tup = (rec['proto'], rec['id.orig_h'], rec['id.orig_p'], rec['id.resp_h'], rec["id.resp_p"])
-            tup = ' '.join(str(f) for f in tup)
-            try:
-                node = get_node_name(rec)
-            except KeyError:
-                node = "bro"
-            finally:
-                tuples[tup].append(node)
-
-        bad = [(tup, len(nds), set(nds)) for (tup, nds) in tuples.items() if len(nds) > 1]
-        bad_pct = percent(len(bad), len(tuples))
+        bad = acc.duplicates()
+        bad_count = acc.duplicate_count()
+        distinct = acc.distinct()
+        bad_pct = percent(bad_count, distinct)
+        if acc.error_rate():
+            self.message("Estimated using a {}MB sketch, up to {:.2f}% of connections may be miscounted".format(
+                self._options["duplicate_sketch"], 100 * acc.error_rate()))
         if bad_pct >= 1:
-            self.err("{:.2f}%, {} out of {} connections appear to be duplicate".format(bad_pct, len(bad), len(tuples)))
+            self.err("{:.2f}%, {} out of {} connections appear to be duplicate".format(bad_pct, bad_count, distinct))
             self.err("First 20:")
             for tup, cnt, unds in bad[:20]:
                 msg = "count={} {}".format(cnt, tup)
@@ -424,39 +3085,34 @@ class Doctor(PluginBase.Plugin):
                     msg = msg + " on {} workers ({})".format(len(unds), ', '.join(ex))
                 self.message(msg)
         else:
-            self.ok("ok, only {:.2f}%, {} out of {} connections appear to be duplicate".format(bad_pct, len(bad), len(tuples)))
+            self.ok("ok, only {:.2f}%, {} out of {} connections appear to be duplicate".format(bad_pct, bad_count, distinct))
             
-        return not bool(bad)
+        return not bad_count
 
     def check_connection_distribution(self):
         """Checking if connections are unevenly distributed across workers
 
         Usually, connections should be distributed evenly across workers. If connections are
         unevenly distributed, load balancing might be not working properly.
+        The bytes and packets of each worker are shown too, along with any flows
+        that stand out by bytes, as a few large flows can overload one worker on their own.
         """
 
-        files = find_recent_log_files(self.log_directory, "conn.*", days=1)
-        if not files:
+        acc = self._conn_scan("check_connection_distribution")
+        if acc is None:
             self.err("No conn log files in the past day???")
             return False
 
-        nodes = defaultdict(int)
-        for rec in read_bro_logs_with_line_limit(reversed(files), 10000):
-            try:
-                node = get_node_name(rec)
-            except KeyError:
-                self.err("No node names in conn log. Install add-node-names package to add a corresponding field.")
-                return False
-            else:
-                nodes[node] += 1
+        if acc.missing_node_names:
+            self.err("No node names in conn log. Install add-node-names package to add a corresponding field.")
+            return False
+        nodes = acc.nodes
 
         if len(nodes) == 1:
             self.ok("Only one worker appears to be in use, unable to check distribution.")
             return True
 
-        mean = float(sum(nodes.values())) / len(nodes)
-        variance = reduce(lambda var, cnt: var + (cnt - mean)**2, nodes.values(), 0) / len(nodes)
-        rsd = sqrt(variance) / mean
+        rsd = relative_std_dev(list(nodes.values()))
 
         if rsd > 0.1:
             self.err("The distribution of connections across workers seems uneven:")
@@ -465,6 +3121,24 @@ class Doctor(PluginBase.Plugin):
         for nd in nodes:
             self.message("{}:\t{} connections".format(nd, nodes[nd]))
 
+        octets = [acc.bytes[nd] for nd in nodes]
+        if not any(octets):
+            self.message("No byte counts in conn log, unable to check the distribution of bytes.")
+            return not (rsd > 0.1)
+        # Bytes follow the flows more than the balancing, so they are only shown
+        self.message("The bytes across workers have a relative standard deviation of {:.2f}:".format(
+            relative_std_dev(octets)))
+        for nd in nodes:
+            self.message("{}:\t{:.1f} MB in {} packets".format(nd, acc.bytes[nd] / 1e6, acc.packets[nd]))
+
+        heavy = acc.heavy_flows()
+        if heavy:
+            self.message("Heaviest flows:")
+        for nd in sorted(heavy):
+            for flow, count, error in heavy[nd]:
+                size = "{:.1f} to {:.1f}".format((count - error) / 1e6, count / 1e6) if error else "{:.1f}".format(count / 1e6)
+                self.message("{}:\t{} MB {}".format(nd, size, flow))
+
         return not (rsd > 0.1)
 
     def check_SAD_connections(self):
@@ -474,35 +3148,16 @@ class Doctor(PluginBase.Plugin):
         this indicates that bro is only seeing half of the connection.
         """
 
-        files = find_recent_log_files(self.log_directory, "conn.*", days=1)
-        if not files:
+        acc = self._conn_scan("check_SAD_connections")
+        if acc is None:
             self.err("No conn log files in the past day???")
             return False
 
-        ok = bad = 0
-        for rec in read_bro_logs_with_line_limit(reversed(files), 100000):
-            # Ignore connections with no history
-            if 'history' not in rec:
-                continue
-            # Ignore non tcp
-            if rec['proto'] != 'tcp':
-                continue
-            # Ignore connections that don't even appear to be from our address space
-            if rec['local_orig'] not in ('T', True) and rec['local_resp'] not in ('T', True):
-                continue
-            h = rec['history'].replace("^", "")
-            #Ignore one packet connections
-            if len(h) == 1:
-                continue
-            if all_lowercase(h) or all_uppercase(h):
-                bad += 1
-            else:
-                ok += 1
-
-        total = ok + bad
+        bad, total = acc.counts()
         pct = percent(bad, total)
-        msg = "{:.2f}%, {} out of {} connections are half duplex".format(pct, bad, total)
-        return self.ok_if(msg, pct <= 1)
+        low, high = acc.interval()
+        msg = "{:.2f}% ({:.2f}% to {:.2f}%), {} out of {} connections are half duplex".format(pct, low, high, bad, total)
+        return self.ok_if(msg, pct <= acc.threshold)
         
     def check_malloc(self):
         """Checking if bro is linked against a custom malloc like tcmalloc or jemalloc
@@ -555,33 +3210,119 @@ class Doctor(PluginBase.Plugin):
         considered local.
         """
 
-        files = find_recent_log_files(self.log_directory, "conn.*", days=1)
-        if not files:
+        acc = self._conn_scan("check_local_connections")
+        if acc is None:
             self.err("No conn log files in the past day???")
             return False
 
-        local = no_local = 0
-        for rec in read_bro_logs_with_line_limit(reversed(files), 100000):
-            if rec['local_orig'] not in ('T', True) and rec['local_resp'] not in ('T', True):
-                no_local +=1
-            else:
-                local += 1
-
-        total = no_local + local
+        no_local, total = acc.counts()
         pct = percent(no_local, total)
-        msg = "{:.2f}%, {} out of {} connections are remote to remote".format(pct, no_local, total)
-        return self.ok_if(msg, pct <= 2)
+        low, high = acc.interval()
+        msg = "{:.2f}% ({:.2f}% to {:.2f}%), {} out of {} connections are remote to remote".format(pct, low, high, no_local, total)
+        return self.ok_if(msg, pct <= acc.threshold)
+
+    def check_worker_load(self):
+        """Checking if workers are dropping packets or using all of their CPU
+
+        Each host is sampled twice, a few seconds apart, for the packets its
+        interfaces dropped and the CPU each worker used.  A worker that uses a
+        whole CPU can't keep up with its share of the traffic.  Workers pinned
+        to the same CPU are reported too, as they have to share it.
+        """
+        hosts = {}
+        for n in self.nodes():
+            if n.interface:
+                hosts.setdefault(n.host, []).append(n)
+        if not hosts:
+            self.message("No nodes capture from an interface")
+            return True
+
+        cmds = []
+        pids = {}
+        devices = {}
+        for host in sorted(hosts):
+            for n in hosts[host]:
+                pid = n.getPID()
+                pids[n] = str(int(pid)) if pid is not None else None
+            devices[host] = sorted(set(d for n in hosts[host] for d in interface_devices(n.interface)))
+            cmds.append((hosts[host][0], self._load_command([pids[n] for n in hosts[host] if pids[n]], devices[host])))
+
+        ok = True
+        for node, success, output in self._execute(cmds):
+            samples, clock_ticks, online, affinity = parse_load_output(output)
+            if not success or len(samples) < 2 or None in (samples[0]["uptime"], samples[-1]["uptime"]):
+                self.err("Could not sample the load on {}: {}".format(node.host, " ".join(output[-3:]).strip()))
+                ok = False
+                continue
+            first, last = samples[0], samples[-1]
+            elapsed = last["uptime"] - first["uptime"]
+
+            pinned = defaultdict(list)
+            for n in hosts[node.host]:
+                pid = pids[n]
+                if pid not in first["cpu"] or pid not in last["cpu"]:
+                    self.err("{} is not running on {}".format(n, node.host))
+                    ok = False
+                    continue
+                cpu = percent(float(last["cpu"][pid] - first["cpu"][pid]) / clock_ticks, elapsed)
+                cpus = affinity.get(pid, "")
+                msg = "{}: {:.0f}% CPU, may run on CPUs {}".format(n, cpu, cpus or "unknown")
+                ok = self.ok_if(msg, cpu < LOAD_CPU_PEGGED) and ok
+                if cpus.isdigit() and online > 1:
+                    pinned[cpus].append(str(n))
+            for cpu, names in sorted(pinned.items()):
+                if len(names) > 1:
+                    self.err("{} are all pinned to CPU {} on {}".format(", ".join(names), cpu, node.host))
+                    ok = False
+
+            for dev in devices[node.host]:
+                if dev not in first["dev"] or dev not in last["dev"]:
+                    self.err("{} has no interface {}".format(node.host, dev))
+                    ok = False
+                    continue
+                packets = last["dev"][dev][0] - first["dev"][dev][0]
+                drops = last["dev"][dev][1] - first["dev"][dev][1]
+                nic_drops = last["nic"][dev] - first["nic"][dev]
+                msg = "{} {}: {} packets in {:.1f}s, {} dropped by the kernel and {} by the NIC".format(
+                    node.host, dev, packets, elapsed, drops, nic_drops)
+                ok = self.ok_if(msg, drops <= 0 and nic_drops <= 0) and ok
+        return ok
 
     def cmd_custom(self, cmd, args, cmdout):
-        args = args.split()
         results = cmdresult.CmdResult()
         results.ok = True
+        try:
+            args, self._options = parse_args(args.split())
+        except ValueError as e:
+            self.err(str(e))
+            results.ok = False
+            return results
+
+        if args[:1] == ['watch']:
+            results.ok = self.watch(args[1:])
+            return results
 
         if args == ['help']:
             self.message("Available checks:")
 
         #self.message("Using log directory {}".format(self.log_directory))
         funcs = [f for f in dir(self) if f.startswith("check_")]
+        self._selected_checks = set(f for f in funcs if not args or f in args)
+        self._conn_accumulators = None
+        self._collected = None
+        self._now = time.time()
+        reset_run_state()
+        self._probes = None
+        profiles = []
+        waits = None
+        if args != ['help']:
+            checks = [f for f in funcs if f in self._selected_checks]
+            groups = set(CHECK_GROUPS.get(f, f) for f in checks)
+            # --profile measures each check on its own
+            if len(groups) > 1 and not self._options["profile"]:
+                waits = self._start_checks(checks)
+            else:
+                self._open_caches()
         for func in funcs:
             f = getattr(self, func)
             short_msg, long_msg = split_doc(f.__doc__)
@@ -593,17 +3334,350 @@ class Doctor(PluginBase.Plugin):
             self.message("#" * (len(short_msg)+4))
             self.message("# {} #".format(short_msg))
             self.message("#" * (len(short_msg)+4))
+            if waits is not None:
+                ok, output = waits[func]()
+                self._replay(output)
+                results.ok = ok and results.ok
+                self.message('')
+                self.message('')
+                continue
+            before, start, cpu_start = dict(io_stats), time.time(), cpu_time()
             try:
                 results.ok = f() and results.ok
             except Exception as e:
                 results.ok = False
                 self.error(traceback.format_exc())
+            profile = dict((k, v - before.get(k, 0)) for k, v in io_stats.items())
+            profile.update(check=func, wall_seconds=time.time() - start, cpu_seconds=cpu_time() - cpu_start)
+            profiles.append(profile)
             self.message('')
             self.message('')
 
+        self._close_caches()
+        self._collected = None
+        self.debug("opened {} log files".format(io_stats["opens"]))
+        if self._options["profile"] and profiles:
+            self._report_profile(profiles)
+        # The log index holds on to the closed ListingCache
+        reset_run_state()
         return results
 
+    def watch(self, checks):
+        """Follow the logs in current/ and print the verdicts of checks every --interval
+
+        Records are counted in WATCH_BUCKETS accumulators per check, each
+        covering a slice of the rolling --window, so memory stays bounded
+        however long this runs.  Stops after --count reports, or on ^C.
+        """
+        checks = dict((name, cls) for log in WATCH_LOGS.values() for name, cls in log.items()
+                      if not checks or name in checks)
+        if not checks:
+            self.err("Checks that can be watched: {}".format(", ".join(sorted(
+                name for log in WATCH_LOGS.values() for name in log))))
+            return False
+        if self._options["duplicate_sketch"] and "check_duplicate_5_tuples" in checks:
+            # Sketches can't be merged across buckets, and partials of one keep every tuple
+            self.err("--duplicate-sketch can't be used with watch")
+            return False
+        window = self._options["window"] or WATCH_WINDOW
+        interval = self._options["interval"]
+        reset_run_state()
+
+        followers = {}
+        for log, accumulators in WATCH_LOGS.items():
+            names = [name for name in accumulators if name in checks]
+            if names:
+                columns = []
+                for name in names:
+                    columns.extend(c for c in checks[name].columns if c not in columns)
+                filename = os.path.join(self.log_directory, "current", log + ".log")
+                followers[log] = (LogFollower(filename, tuple(columns)), names)
+
+        def new_bucket():
+            bucket = {}
+            for name, cls in checks.items():
+                acc = cls.from_options(self._options)
+                acc.limit = None
+                bucket[name] = acc.self_contained_partial()
+            return bucket
+
+        buckets = deque([new_bucket()], maxlen=WATCH_BUCKETS)
+        bucket_start = next_report = time.time()
+        next_report += interval
+        reports = 0
+        ok = True
+        try:
+            while True:
+                now = time.time()
+                if now - bucket_start >= float(window) / WATCH_BUCKETS:
+                    buckets.append(new_bucket())
+                    bucket_start = now
+                for follower, names in followers.values():
+                    accumulators = [buckets[-1][name] for name in names]
+                    for rec in follower.poll():
+                        for a in accumulators:
+                            if a.done:
+                                continue
+                            try:
+                                a.feed(rec)
+                            except Exception:
+                                a.failure = traceback.format_exc()
+                                a.done = True
+                if now >= next_report:
+                    ok = self._watch_report(checks, buckets, window)
+                    reports += 1
+                    if reports == self._options["count"]:
+                        break
+                    next_report += interval
+                time.sleep(max(0, min(WATCH_POLL, next_report - time.time())))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for follower, names in followers.values():
+                follower.close()
+        return ok
+
+    def _watch_report(self, checks, buckets, window):
+        watched = {}
+        for name, cls in checks.items():
+            acc = cls.from_options(self._options)
+            acc.limit = None
+            for bucket in buckets:
+                acc.merge(bucket[name])
+            watched[name] = acc
+
+        self.message("==== {}, the last {:g}s ====".format(time.strftime("%H:%M:%S"), window))
+        ok = True
+        self._collected = watched
+        try:
+            for name in sorted(checks):
+                short_msg, long_msg = split_doc(getattr(self, name).__doc__)
+                self.message("# {}".format(short_msg))
+                if not watched[name].seen:
+                    self.message("No new records")
+                    continue
+                try:
+                    ok = getattr(self, name)() and ok
+                except Exception:
+                    ok = False
+                    self.error(traceback.format_exc())
+        finally:
+            self._collected = None
+        self.message('')
+        return ok
+
+    def _report_profile(self, profiles):
+        """Print the --profile table and save it as JSON in the spool directory"""
+        columns = [
+            ("check", "{:<32}"), ("wall_seconds", "{:>7.2f}"), ("cpu_seconds", "{:>7.2f}"), ("opens", "{:>5}"),
+            ("bytes_read", "{:>8.1f}"), ("bytes_decompressed", "{:>8.1f}"),
+            ("records_parsed", "{:>9}"), ("records_used", "{:>9}"),
+            ("remote_commands", "{:>6}"), ("remote_seconds", "{:>7.2f}"),
+        ]
+        self.message("{:<32} {:>7} {:>7} {:>5} {:>8} {:>8} {:>9} {:>9} {:>6} {:>7}".format(
+            "check", "wall s", "cpu s", "files", "disk MB", "data MB", "parsed", "used", "remote", "rmt s"))
+        for profile in profiles:
+            values = [profile.get(k, 0) / 1e6 if k.startswith("bytes") else profile.get(k, 0) for k, fmt in columns]
+            self.message(" ".join(fmt for k, fmt in columns).format(*values))
+
+        filename = os.path.join(self.getGlobalOption("spooldir"), "doctor-profile.json")
+        try:
+            with open(filename, "w") as f:
+                json.dump(profiles, f, indent=1, sort_keys=True)
+            self.message("Profile saved to {}".format(filename))
+        except (OSError, IOError) as e:
+            self.message("warning: could not save profile to {}: {}".format(filename, e))
+
+def _synthetic_ascii(path, fields, types, rows):
+    lines = [
+        "#separator \\x09", "#set_separator\t,", "#empty_field\t(empty)", "#unset_field\t-",
+        "#path\t" + path, "#open\t" + time.strftime("%Y-%m-%d-%H-%M-%S"),
+        "#fields\t" + "\t".join(fields), "#types\t" + "\t".join(types),
+    ]
+    lines.extend("\t".join(str(v) for v in row) for row in rows)
+    lines.append("#close\t" + time.strftime("%Y-%m-%d-%H-%M-%S"))
+    return "\n".join(lines) + "\n"
+
+def _synthetic_json(fields, types, rows):
+    lines = []
+    for row in rows:
+        rec = {}
+        for field, type, value in zip(fields, types, row):
+            if value == "-":
+                continue
+            if type == "bool":
+                value = value == "T"
+            elif type in ("count", "port", "int"):
+                value = int(value)
+            elif type in ("time", "interval", "double"):
+                value = float(value)
+            elif type.startswith(("set[", "vector[")):
+                value = [] if value == "(empty)" else value.split(",")
+            rec[field] = value
+        lines.append(json.dumps(rec))
+    return "\n".join(lines) + "\n"
+
+SYNTHETIC_LOGS = {
+    "conn": (
+        "ts uid id.orig_h id.orig_p id.resp_h id.resp_p proto service duration orig_bytes resp_bytes "
+        "conn_state local_orig local_resp missed_bytes history orig_pkts orig_ip_bytes resp_pkts "
+        "resp_ip_bytes tunnel_parents _node_name".split(),
+        "time string addr port addr port enum string interval count count string bool bool count "
+        "string count count count count set[string] string".split(),
+    ),
+    "capture_loss": (
+        "ts ts_delta peer gaps acks percent_lost".split(),
+        "time interval string count count double".split(),
+    ),
+    "reporter": (
+        "ts level message location".split(),
+        "time enum string string".split(),
+    ),
+}
+
+def synthetic_rows(log, count, workers, start, rng):
+    """Return count plausible rows for a conn, capture_loss or reporter log"""
+    step = 3600.0 / max(count, 1)
+    nodes = ["worker-{}".format(i + 1) for i in range(workers)]
+    rows = []
+    for i in range(count):
+        ts = "{:.6f}".format(start + i * step)
+        node = rng.choice(nodes)
+        if log == "conn":
+            history = rng.choice(["ShADadFf", "ShADadfF", "ShAdDaFf", "S", "D", "Dd", "ShADdaR", "^hADadfF", "SAD", "ad"])
+            rows.append([
+                ts, "C{:x}".format(rng.getrandbits(64)),
+                "10.{}.{}.{}".format(rng.randint(0, 3), rng.randint(0, 255), rng.randint(1, 254)), rng.randint(1024, 65535),
+                "192.0.2.{}".format(rng.randint(1, 254)), rng.choice([22, 53, 80, 443]),
+                rng.choice(["tcp", "tcp", "tcp", "udp", "icmp"]), rng.choice(["http", "ssl", "dns", "-"]),
+                "{:.6f}".format(rng.expovariate(1)), rng.randint(0, 10 ** 6), rng.randint(0, 10 ** 6),
+                "SF", rng.choice("TTTF"), rng.choice("TFFF"), rng.choice([0] * 50 + [1460]),
+                history, rng.randint(1, 1000), rng.randint(40, 10 ** 6), rng.randint(0, 1000), rng.randint(0, 10 ** 6),
+                "(empty)", node,
+            ])
+        elif log == "capture_loss":
+            acks = rng.randint(1000, 100000)
+            gaps = rng.choice([0, 0, 0, rng.randint(0, acks // 20)])
+            rows.append([ts, "900.000000", node, gaps, acks, "{:.6f}".format(percent(gaps, acks))])
+        else:
+            rows.append([ts, rng.choice(["Reporter::WARNING", "Reporter::ERROR"]),
+                "too many connections from 10.0.0.{} port {}".format(rng.randint(1, 254), rng.randint(1, 65535)), "-"])
+    return rows
+
+def write_synthetic_logs(logdir, fmt="ascii", records=100000, files=4, workers=8, seed=1, duplicates=0):
+    """Write a synthetic broctl log archive of conn, capture_loss and reporter logs
+
+    logdir gets files rotated hourly logs per type in the archive directory
+    of the day each was opened, compressed with gzip, plus the current log
+    in current/.  Each conn log has records rows, the others proportionally
+    fewer.  fmt is "ascii" or "json".  A duplicates fraction of records is
+    logged again by one more worker, from the same conn log or the one before.
+    """
+    rng = random.Random(seed)
+    now = time.time()
+    start = now - now % 3600
+    if not os.path.isdir(os.path.join(logdir, "current")):
+        os.makedirs(os.path.join(logdir, "current"))
+    sizes = {"conn": records, "capture_loss": max(records // 1000, workers), "reporter": max(records // 100, 1)}
+    for log, (fields, types) in SYNTHETIC_LOGS.items():
+        earlier = []
+        for i in range(files + 1):
+            opened = start - (files - i) * 3600
+            rows = synthetic_rows(log, sizes[log], workers, opened, rng)
+            if log == "conn" and duplicates:
+                again = rng.sample(rows + earlier, int(records * duplicates))
+                earlier = rows
+                rows = rows + [row[:-1] + ["worker-{}".format(workers + 1)] for row in again]
+            data = _synthetic_ascii(log, fields, types, rows) if fmt == "ascii" else _synthetic_json(fields, types, rows)
+            data = data.encode('latin-1')
+            if i == files:
+                with open(os.path.join(logdir, "current", log + ".log"), "wb") as f:
+                    f.write(data)
+                continue
+            day = os.path.join(logdir, time.strftime("%Y-%m-%d", time.localtime(opened)))
+            if not os.path.isdir(day):
+                os.makedirs(day)
+            name = "{}.{}-{}.log.gz".format(log, time.strftime("%H:%M:%S", time.localtime(opened)),
+                time.strftime("%H:%M:%S", time.localtime(opened + 3600)))
+            with gzip.open(os.path.join(day, name), "wb") as f:
+                f.write(data)
+
+def peak_rss_mb():
+    """The peak RSS of this process or any of its finished children, in MB"""
+    rss = max(resource.getrusage(who).ru_maxrss for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN))
+    # kilobytes on Linux, bytes on macOS
+    return rss / (1024.0 * 1024 if sys.platform == "darwin" else 1024.0)
+
+def _measure(sender, func, args):
+    start = time.time()
+    result = func(*args)
+    sender.send((result, time.time() - start, peak_rss_mb()))
+
+def measured(func, *args):
+    """Run func(*args) in a forked process, returning (result, seconds, peak MB)
+
+    The peak is that process's own, so it doesn't carry over from the
+    benchmarks before.
+    """
+    receiver, sender = multiprocessing.Pipe(False)
+    context = fork_context()
+    process = context.Process(target=_measure, args=(sender, func, args))
+    process.start()
+    sender.close()
+    try:
+        return receiver.recv()
+    finally:
+        process.join()
+
+def run_benchmarks(args):
+    """Benchmark the log readers and log checks on synthetic logs
+
+    Usage: python doctor.py bench [--records N] [--files N] [--workers N] [--dir D]
+    """
+    settings = {"records": 100000, "files": 4, "workers": 8, "dir": None}
+    while args:
+        name = args.pop(0).lstrip("-")
+        if name not in settings or not args:
+            print(run_benchmarks.__doc__.strip().split("\n")[-1])
+            return 1
+        settings[name] = args.pop(0) if name == "dir" else int(args.pop(0))
+
+    base = settings["dir"] or tempfile.mkdtemp(prefix="doctor-bench-")
+    print("Writing synthetic logs to {}".format(base))
+    for fmt in "ascii", "json":
+        write_synthetic_logs(os.path.join(base, fmt), fmt, settings["records"], settings["files"], settings["workers"])
+
+    print("")
+    print("{:<8} {:<30} {:<9} {:>12} {:>10} {:>10}".format("format", "log", "columns", "records/sec", "MB/sec", "peak MB"))
+    for fmt in "ascii", "json":
+        logdir = os.path.join(base, fmt)
+        for log in [os.path.join(logdir, "current", "conn.log")] + find_recent_log_files(logdir, "conn.*.gz", days=1)[:1]:
+            size = os.path.getsize(log)
+            for columns in None, ConnLossAccumulator.columns:
+                count, elapsed, peak = measured(lambda: sum(1 for _ in read_bro_log(log, columns)))
+                elapsed = max(elapsed, 1e-9)
+                print("{:<8} {:<30} {:<9} {:>12.0f} {:>10.1f} {:>10.1f}".format(fmt, os.path.basename(log),
+                    "all" if columns is None else len(columns), count / elapsed, size / elapsed / 1e6, peak))
+
+    print("")
+    print("{:<8} {:<32} {:>10} {:>10}".format("format", "check", "seconds", "peak MB"))
+    checks = ["check_reporter", "check_capture_loss"] + sorted(CONN_ACCUMULATORS)
+    for fmt in "ascii", "json":
+        doctor = Doctor()
+        doctor.global_options = {"logdir": os.path.join(base, fmt), "spooldir": base, "sitepolicypath": base}
+        doctor.init()
+        doctor.message = doctor.error = lambda msg: None
+        for check in checks:
+            _, elapsed, peak = measured(doctor.cmd_custom, "doctor", "--no-cache " + check, None)
+            print("{:<8} {:<32} {:>10.3f} {:>10.1f}".format(fmt, check, elapsed, peak))
+    return 0
+
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["bench"]:
+        sys.exit(run_benchmarks(sys.argv[2:]))
+    if sys.argv[1:2] == ["partials"]:
+        sys.exit(print_partials(sys.argv[2:]))
+
     print(__doc__)
     funcs = [f for f in dir(Doctor) if f.startswith("check_")]
 
@@ -619,7 +3693,28 @@ if __name__ == "__main__":
     print("""
 # Usage
 
-    broctl doctor.bro [check] [check]
+    broctl doctor.bro [options] [check] [check]
+    broctl doctor.bro watch [options] [check] [check]
+
+## Options
+
+    --jobs N    Read log files using N worker processes
+    --no-cache  Do not use or update the cache of results for rotated logs
+    --duplicate-sketch MB
+                Find duplicate connections approximately using at most MB
+                megabytes of memory; not with watch
+    --window T  Check all records from the last T (like 90s, 15m, 1h or 2d)
+                instead of a fixed number of the most recent ones
+    --profile   Show the time, I/O and records read for each check, and
+                save them to doctor-profile.json in the spool directory;
+                the checks then run one at a time instead of concurrently
+    --interval T
+                With watch, print the verdicts every T (default 10s)
+    --count N   With watch, stop after N reports
+    --loggers   Read the logs on each logger node instead of the log
+                directory here, for the conn, capture loss and reporter checks
+    --sample    Sample the conn checks from evenly spread parts of the whole
+                day of conn logs instead of reading the most recent records
 
 ## Examples
 Run all checks
@@ -630,4 +3725,26 @@ Run just the duplicate check
 
     broctl doctor.bro check_duplicate_5_tuples
 
+Read the logs using 4 processes
+
+    broctl doctor.bro --jobs 4
+
+Follow the current logs, printing verdicts for the last 5 minutes (or
+--window) every 10 seconds
+
+    broctl doctor.bro watch
+
+JSON logs are read faster when orjson, ujson or simdjson is installed, and
+numpy is used for the capture loss and distribution statistics if available.
+
+# Benchmarks
+
+The log readers and log checks can be benchmarked on synthetic logs without
+broctl:
+
+    python doctor.py bench [--records N] [--files N] [--workers N] [--dir D]
+
+Each benchmark runs in a forked process of its own, so its peak MB is the
+most memory that process and any it started used, starting from the size
+of the benchmark process itself.
 """)
@@ -0,0 +1,789 @@
+"""Tests for the log reading and accumulators of doctor.py
+
+Run with "python -m unittest discover tests" or pytest, without broctl.
+"""
+from __future__ import print_function
+import base64
+import gzip
+import io
+import itertools
+import os
+import pickle
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import doctor
+
+def gzip_member(data):
+    c = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return c.compress(data) + c.flush()
+
+def write_conn_logs(logdir, fmt="ascii"):
+    """Write synthetic logs with some connections logged twice, returning the conn logs newest first"""
+    doctor.write_synthetic_logs(logdir, fmt, records=1500, files=3, workers=4, duplicates=0.05)
+    return doctor.find_recent_log_files(logdir, "conn.*")[::-1]
+
+def summary(acc):
+    """What the checks report from acc, to compare accumulators by"""
+    if isinstance(acc, doctor.ProportionAccumulator):
+        return acc.counts()
+    if isinstance(acc, doctor.DistributionAccumulator):
+        # Not heavy_flows(): with more flows than counters which are listed
+        # depends on the order partials merge in
+        return dict(acc.nodes), dict(acc.packets), dict(acc.bytes)
+    if isinstance(acc, doctor.CaptureLossAccumulator):
+        return dict((w, (s.summary(), s.gaps, s.acks)) for w, s in acc.workers.items())
+    if isinstance(acc, doctor.ReporterAccumulator):
+        return dict(acc.levels), acc.templates.top()
+    return acc.distinct(), acc.duplicate_count(), sorted(acc.duplicates())
+
+ASCII_LOG = b"""#separator \\x09
+#set_separator\t,
+#empty_field\t(empty)
+#unset_field\t-
+#path\tconn
+#fields\tts\tuid\tid.orig_h\t_node_name\ttunnel_parents\thistory
+#types\ttime\tstring\taddr\tstring\tvector[string]\tstring
+1500000000.000001\tCa\t10.0.0.1\tworker-1\tCx,Cy\tShADadFf
+1500000001.000001\tCb\t10.0.0.2\tworker-2\t(empty)\tS
+#close\t2017-07-14-02-40-01
+"""
+
+class TestProjection(unittest.TestCase):
+    """Records projected onto columns hold what the full records do"""
+
+    def read(self, columns, data=ASCII_LOG):
+        return list(doctor.bro_ascii_reader(io.BytesIO(data), columns))
+
+    def check(self, columns, data=ASCII_LOG):
+        full = self.read(None, data)
+        projected = self.read(columns, data)
+        self.assertEqual(len(projected), len(full))
+        node = lambda c: "_node_name" if c == doctor.NODE_COLUMN else c
+        for rec, expected in zip(projected, full):
+            self.assertEqual(tuple(rec), tuple(expected.get(node(c)) for c in columns))
+        return projected
+
+    def test_columns(self):
+        rec = self.check(("uid", "id.orig_h"))[0]
+        self.assertEqual((rec.uid, rec.id_orig_h), ("Ca", "10.0.0.1"))
+        # In another order than the log's, and alone
+        self.check(("id.orig_h", "ts"))
+        self.check(("uid",))
+
+    def test_last_column(self):
+        # Without the line terminator
+        self.assertEqual([rec.history for rec in self.check(("history",))], ["ShADadFf", "S"])
+        self.assertEqual([rec.history for rec in self.check(("ts", "history"), ASCII_LOG.replace(b"\n", b"\r\n"))],
+                         ["ShADadFf", "S"])
+
+    def test_vector_column(self):
+        recs = self.check(("tunnel_parents", "uid"))
+        self.assertEqual([rec.tunnel_parents for rec in recs], [["Cx", "Cy"], ["(empty)"]])
+
+    def test_missing_column(self):
+        recs = self.check(("uid", "service"))
+        self.assertEqual([rec.service for rec in recs], [None, None])
+        self.assertEqual([tuple(rec) for rec in self.read(("service",))], [(None,), (None,)])
+
+    def test_node_column(self):
+        recs = self.check((doctor.NODE_COLUMN, "uid"))
+        self.assertEqual([rec.node for rec in recs], ["worker-1", "worker-2"])
+
+    def test_json(self):
+        data = b'{"ts":1500000000.000001,"uid":"Ca","_node_name":"worker-1","tunnel_parents":["Cx","Cy"]}\n' \
+               b'{"ts":1500000001.000001,"uid":"Cb","_node_name":"worker-2"}\n'
+        recs = list(doctor.bro_json_reader(io.BytesIO(data), ("uid", "tunnel_parents", doctor.NODE_COLUMN, "service")))
+        self.assertEqual([tuple(rec) for rec in recs],
+                         [("Ca", ["Cx", "Cy"], "worker-1", None), ("Cb", None, "worker-2", None)])
+
+class Output(list):
+    """Stands in for sys.stderr, keeping what was written"""
+    def write(self, s):
+        self.append(s)
+
+class TestJsonReader(unittest.TestCase):
+    def test_prefilter(self):
+        lines = [
+            b'{"uid":"Ca","proto":"tcp"}',
+            b'{"uid":"Cb","proto":"udp"}',
+            # Not compact, so decoded
+            b'{"uid": "Cc", "proto": "udp"}',
+            # Without the column
+            b'{"uid":"Cd"}',
+        ]
+        recs = list(doctor.bro_json_reader(io.BytesIO(b"\n".join(lines) + b"\n"), ("uid", "proto"), match=("proto", "tcp")))
+        self.assertEqual([rec and tuple(rec) for rec in recs], [("Ca", "tcp"), None, ("Cc", "udp"), ("Cd", None)])
+
+    def test_prefilter_scan(self):
+        # Distribution has no prefilter, so reading along with it decodes every line
+        logdir = tempfile.mkdtemp()
+        try:
+            files = write_conn_logs(logdir, "json")
+            filtered, unfiltered = doctor.ConnLossAccumulator(), doctor.ConnLossAccumulator()
+            doctor.scan_logs(files, [filtered])
+            doctor.scan_logs(files, [unfiltered, doctor.DistributionAccumulator()])
+            self.assertEqual((filtered.counts(), filtered.seen), (unfiltered.counts(), unfiltered.seen))
+            self.assertTrue(filtered.counts()[1])
+        finally:
+            shutil.rmtree(logdir)
+
+    def test_corrupt_lines(self):
+        data = b'{"uid":"Ca"}\n' + b'{"uid":\n' * (doctor.MAX_CORRUPT_LINES + 3) + b'{"uid":"Cb"}\n'
+        stderr = sys.stderr
+        sys.stderr = output = Output()
+        try:
+            recs = list(doctor.bro_json_reader(io.BytesIO(data), ("uid",)))
+        finally:
+            sys.stderr = stderr
+        self.assertEqual([rec.uid for rec in recs], ["Ca", "Cb"])
+        self.assertEqual(len(output), doctor.MAX_CORRUPT_LINES + 1)
+        self.assertEqual(output[-1], "Skipped 3 more corrupt json log lines\n")
+
+class TestMergeEquivalence(unittest.TestCase):
+    """Merging partials, in a pool or from the cache, gives the result of reading in order"""
+
+    accumulators = [
+        doctor.SADAccumulator,
+        doctor.ConnLossAccumulator,
+        doctor.LocalConnectionAccumulator,
+        doctor.DistributionAccumulator,
+        doctor.DuplicateTupleAccumulator,
+        lambda: doctor.DuplicateSketchAccumulator(1 << 16),
+    ]
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def scan(self, files, make, limit, jobs=1, cache=None):
+        acc = make()
+        acc.limit = limit
+        doctor.scan_logs(files, [acc], jobs, cache)
+        self.assertIsNone(acc.failure)
+        return acc
+
+    def check_format(self, fmt):
+        files = write_conn_logs(os.path.join(self.dir, fmt), fmt)
+        cache = doctor.PartialCache(os.path.join(self.dir, fmt + "-cache.sqlite"))
+        try:
+            for make in self.accumulators:
+                # A limit that ends in the middle of the oldest log, and none
+                for limit in 4000, None:
+                    serial = self.scan(files, make, limit)
+                    expected = summary(serial), serial.seen
+                    for jobs, c in (2, None), (1, cache), (1, cache), (2, cache):
+                        acc = self.scan(files, make, limit, jobs, c)
+                        self.assertEqual((summary(acc), acc.seen), expected,
+                            "{} limit={} jobs={} cache={}".format(acc.__class__.__name__, limit, jobs, c is not None))
+        finally:
+            cache.close()
+
+    def test_ascii(self):
+        self.check_format("ascii")
+
+    def test_json(self):
+        self.check_format("json")
+
+    def test_other_logs(self):
+        doctor.write_synthetic_logs(self.dir, records=20000, files=3)
+        cache = doctor.PartialCache(os.path.join(self.dir, "cache.sqlite"))
+        try:
+            for log, make in ("capture_loss", doctor.CaptureLossAccumulator), ("reporter", doctor.ReporterAccumulator):
+                files = doctor.find_recent_log_files(self.dir, log + ".*")[::-1]
+                serial = self.scan(files, make, None)
+                for jobs, c in (2, None), (1, cache), (1, cache):
+                    acc = self.scan(files, make, None, jobs, c)
+                    self.assertEqual(summary(acc), summary(serial), "{} jobs={}".format(log, jobs))
+        finally:
+            cache.close()
+
+    def test_duplicates_across_logs_are_named(self):
+        files = write_conn_logs(self.dir)
+        acc = self.scan(files, doctor.DuplicateTupleAccumulator, None, 2)
+        names = [tup for tup, count, nodes in acc.duplicates()]
+        self.assertTrue(names)
+        self.assertFalse([n for n in names if n.startswith("unknown tuple")])
+        # Partials only keep the names of their own duplicates
+        partial = acc.partial()
+        doctor.scan_logs(files[1:2], [partial])
+        self.assertEqual(len(partial.names), partial.duplicate_count())
+
+class TestDuplicateSketch(unittest.TestCase):
+    """DuplicateSketchAccumulator counts and its error rate"""
+
+    def test_counts_and_error_rate(self):
+        acc = doctor.DuplicateSketchAccumulator(1 << 20)
+        self.assertEqual(acc.error_rate(), 0.0)
+        Record = doctor.record_type(acc.columns)
+        for i in list(range(300)) + list(range(50)):
+            acc.feed(Record("ShADadFf", "10", "20", "tcp", "10.0.0.1", str(i), "192.0.2.1", "80", "worker-1"))
+        self.assertEqual((acc.distinct(), acc.duplicate_count()), (300, 50))
+        used = sum(1 for c in acc.counters if c)
+        self.assertTrue(0 < used <= 300 * doctor.SKETCH_HASHES)
+        self.assertAlmostEqual(acc.error_rate(), (float(used) / acc.size) ** doctor.SKETCH_HASHES)
+
+class TestGzipIndex(unittest.TestCase):
+    """GzipIndex and zlib_chunks read multi-member files like plain decompression"""
+
+    def setUp(self):
+        rng = random.Random(2)
+        self.members = []
+        for n in 20000, 1, 35000:
+            lines = ["{:.6f}\t10.0.{}.{}\t{}".format(1e9 + i, rng.randint(0, 255), rng.randint(1, 254),
+                rng.choice(["ShADadFf", "S", "Dd"])) for i in range(n)]
+            self.members.append(("\n".join(lines) + "\n").encode('latin-1'))
+        self.plain = b"".join(self.members)
+        fd, self.path = tempfile.mkstemp(suffix=".log.gz")
+        with os.fdopen(fd, "wb") as f:
+            # gzip allows zero padding after a member
+            f.write(gzip_member(self.members[0]) + gzip_member(self.members[1]) + b"\0" * 7 + gzip_member(self.members[2]))
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_plain_decompression_agrees(self):
+        with gzip.open(self.path, "rb") as f:
+            self.assertEqual(f.read(), self.plain)
+
+    @unittest.skipUnless(doctor.load_libz(), "needs the system zlib")
+    def test_reads_match(self):
+        with open(self.path, "rb") as f:
+            index = doctor.GzipIndex.build(f, span=16384)
+            self.assertEqual(index.size, len(self.plain))
+            self.assertTrue(len(index.points) > 3)
+            member_ends = []
+            for m in self.members:
+                member_ends.append((member_ends[-1] if member_ends else 0) + len(m))
+            starts = [p[0] for p in index.points]
+            for i, (start, end) in enumerate(zip(starts, starts[1:] + [index.size])):
+                # A read stops at the end of the member it starts in
+                stop = min(e for e in member_ends if e > start)
+                self.assertEqual(index.read(f, i, end - start), self.plain[start:min(end, stop)])
+                self.assertEqual(index.read(f, i, 100), self.plain[start:min(start + 100, stop)])
+
+    def test_zlib_chunks(self):
+        with open(self.path, "rb") as f:
+            self.assertEqual(b"".join(doctor.zlib_chunks(f)), self.plain)
+
+    def test_zlib_chunks_truncated(self):
+        with open(self.path, "rb") as f:
+            data = f.read()
+        with open(self.path, "wb") as f:
+            f.write(data[:-20])
+        with open(self.path, "rb") as f:
+            self.assertRaises(EOFError, lambda: b"".join(doctor.zlib_chunks(f)))
+
+class TestReverseLines(unittest.TestCase):
+    """reverse_lines and tail_lines on logs with and without a partial last line"""
+
+    def reverse(self, data, start=0):
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            results = []
+            # Memory mapped, and read through the file object
+            for f in open(path, "rb"), io.BytesIO(data):
+                with f:
+                    for blocksize in 1, 3, 1 << 20:
+                        results.append(list(doctor.reverse_lines(f, start, blocksize)))
+        finally:
+            os.remove(path)
+        for r in results[1:]:
+            self.assertEqual(r, results[0])
+        return results[0]
+
+    def test_complete_last_line(self):
+        self.assertEqual(self.reverse(b"#fields\ta\nab\nc\n\ndef\n"), [b"def", b"c", b"ab"])
+
+    def test_partial_last_line(self):
+        # Still being written, so left out
+        self.assertEqual(self.reverse(b"#fields\ta\nab\nc\ndef"), [b"c", b"ab"])
+        self.assertEqual(self.reverse(b"def"), [])
+        self.assertEqual(self.reverse(b""), [])
+
+    def test_start(self):
+        data = b"#fields\ta\nab\nc\n"
+        self.assertEqual(self.reverse(data, data.index(b"ab")), [b"c", b"ab"])
+        self.assertEqual(self.reverse(data, len(data)), [])
+
+    def test_tail_lines(self):
+        lines = lambda data, limit: list(doctor.tail_lines(io.BytesIO(data), limit))
+        self.assertEqual(lines(b"#fields\ta\nab\nc\ndef\n", 2), [b"def\n", b"c\n"])
+        self.assertEqual(lines(b"#fields\ta\nab\nc\ndef\n", None), [b"def\n", b"c\n", b"ab\n"])
+        # Compressed logs are complete, so their last line is kept
+        self.assertEqual(lines(b"#fields\ta\nab\nc\ndef", 2), [b"def", b"c\n"])
+
+LOAD_OUTPUT = """clk_tck 100
+cpus 4
+affinity 4242 Cpus_allowed_list:\t2
+affinity 4243 Cpus_allowed_list:\t0-3
+uptime 1000.00 3000.00
+==doctor-load==
+uptime 1000.00 3000.00
+dev Inter-|   Receive                                                |  Transmit
+dev  face |bytes    packets errs drop fifo frame compressed multicast|bytes    packets errs drop fifo colls carrier compressed
+dev   eth0: 5000000 10000 0 7 1 0 0 0 900 9 0 0 0 0 0 0
+dev     lo: 100 2 0 0 0 0 0 0 100 2 0 0 0 0 0 0
+stat 4242 4242 (zeek (worker)) R 1 4242 4242 0 -1 4194560 10 0 0 0 500 100 0 0 20 0 8 0 100 0 0
+stat 4243 4243 (zeek) S 1 4243 4243 0 -1 4194560 10 0 0 0 40 10 0 0 20 0 8 0 100 0 0
+ethtool eth0 NIC statistics:
+ethtool eth0      rx_packets: 10000
+ethtool eth0      rx_dropped: 5
+ethtool eth0      rx_missed_errors: 2
+ethtool eth0      tx_dropped: 30
+==doctor-load==
+uptime 1003.00 3010.00
+dev   eth0: 9000000 20000 0 10 1 0 0 0 900 9 0 0 0 0 0 0
+dev     lo: 100 2 0 0 0 0 0 0 100 2 0 0 0 0 0 0
+stat 4242 4242 (zeek (worker)) R 1 4242 4242 0 -1 4194560 10 0 0 0 700 200 0 0 20 0 8 0 100 0 0
+ethtool eth0      rx_dropped: 9
+ethtool eth0      rx_missed_errors: 2
+ethtool eth0      tx_dropped: 90
+""".splitlines()
+
+class TestHeavyFlows(unittest.TestCase):
+    """DistributionAccumulator.heavy_flows finds the flows carrying the most bytes"""
+
+    def stream(self, heavy, rng):
+        """Records of light flows, more of them than counters, and of heavy, {flow: {node: bytes}}"""
+        Record = doctor.record_type(doctor.DistributionAccumulator.columns)
+        records = []
+        for i in range(3 * doctor.HEAVY_FLOWS):
+            records.append(Record("worker-{}".format(i % 4), "tcp", "10.1.{}.{}".format(i // 250, i % 250),
+                                  "192.0.2.1", "443", "2", "600", "2", "400"))
+        for flow, nodes in heavy.items():
+            proto, orig_h, resp_h, resp_p = flow.split()
+            for node, octets in nodes.items():
+                for _ in range(octets // 100000):
+                    records.append(Record(node, proto, orig_h, resp_h, resp_p, "70", "60000", "30", "40000"))
+        rng.shuffle(records)
+        return records
+
+    def check(self, acc, heavy, shown):
+        flows = acc.heavy_flows()
+        self.assertEqual(sorted(flows), sorted(shown))
+        for node, listed in flows.items():
+            self.assertEqual([flow for flow, count, error in listed], shown[node])
+            for flow, count, error in listed:
+                weight = sum(heavy[flow].values())
+                self.assertTrue(count - error <= weight <= count, flow)
+
+    def test_heavy_flows(self):
+        heavy = {
+            "tcp 10.0.0.1 192.0.2.9 80": {"worker-1": 9000000, "worker-2": 1000000},
+            "tcp 10.0.0.2 192.0.2.9 80": {"worker-1": 5000000},
+            "udp 10.0.0.3 192.0.2.9 53": {"worker-2": 3000000, "worker-1": 2000000},
+            "tcp 10.0.0.4 192.0.2.9 22": {"worker-1": 4000000},
+            "tcp 10.0.0.5 192.0.2.9 22": {"worker-1": 3000000},
+        }
+        records = self.stream(heavy, random.Random(3))
+        # Under the node that logged most of each, at most HEAVY_FLOWS_SHOWN a node
+        shown = {
+            "worker-1": ["tcp 10.0.0.1 192.0.2.9 80", "tcp 10.0.0.2 192.0.2.9 80", "tcp 10.0.0.4 192.0.2.9 22"],
+            "worker-2": ["udp 10.0.0.3 192.0.2.9 53"],
+        }
+        acc = doctor.DistributionAccumulator()
+        acc.limit = None
+        for rec in records:
+            acc.feed(rec)
+        self.check(acc, heavy, shown)
+
+        # Merged from partials of parts of the stream
+        merged = acc.partial()
+        third = len(records) // 3
+        for part in records[:third], records[third:2 * third], records[2 * third:]:
+            p = acc.partial()
+            for rec in part:
+                p.feed(rec)
+            merged.merge(p)
+        self.check(merged, heavy, shown)
+
+    def test_even_traffic(self):
+        acc = doctor.DistributionAccumulator()
+        acc.limit = None
+        for rec in self.stream({}, random.Random(4)):
+            acc.feed(rec)
+        self.assertEqual(dict(acc.heavy_flows()), {})
+
+class TestReporterTemplates(unittest.TestCase):
+    """Reporter messages are counted by template in bounded memory"""
+
+    def test_message_template(self):
+        templates = [
+            ("too many connections from 10.0.0.12 port 5353", "too many connections from <addr> port <num>"),
+            ("expression error in ./main.zeek, line 42: no such index (Cx3pQd1kN0cUQ5Mb9e[2001:db8::1])",
+             "expression error in ./main.zeek, line <num>: no such index (<uid>[<addr>])"),
+            ("connection CHhAvVGS1DHFjwGM9 at 2020-03-01T12:00:00.123Z timed out after 0x1f s",
+             "connection <uid> at <time> timed out after <num> s"),
+            ("SSL::CLIENT_HELLO from 192.168.1.1:443", "SSL::CLIENT_HELLO from <addr>:<num>"),
+            # Nothing to mask
+            ("Failed to open GeoIP database: /usr/share/GeoIP/GeoLiteCity.dat",
+             "Failed to open GeoIP database: /usr/share/GeoIP/GeoLiteCity.dat"),
+        ]
+        for message, template in templates:
+            self.assertEqual(doctor.message_template(message), template)
+
+    def feed(self, acc, messages):
+        Record = doctor.record_type(acc.columns)
+        for i, (level, message) in enumerate(messages):
+            acc.feed(Record("{:.6f}".format(1500000000 + i), level, message, "-"))
+
+    def test_flood(self):
+        acc = doctor.ReporterAccumulator()
+        flood = [("Reporter::WARNING", "too many connections from 10.0.{}.{}".format(i // 250, i % 250)) for i in range(5000)]
+        # More kinds of message than templates are kept
+        names = ["".join(letters) for letters in itertools.product("abcdefghij", repeat=3)]
+        kinds = [("Reporter::ERROR", "unknown identifier " + name) for name in names[:3 * doctor.REPORTER_TEMPLATES]]
+        self.feed(acc, flood[:2500] + kinds + flood[2500:])
+        self.assertEqual(dict(acc.levels), {"Reporter::WARNING": 5000, "Reporter::ERROR": 3 * doctor.REPORTER_TEMPLATES})
+        self.assertTrue(len(acc.templates.counters) <= doctor.REPORTER_TEMPLATES)
+        (level, template), count, error, (first_ts, first, last_ts, last) = acc.templates.top()[0]
+        self.assertEqual((level, template, count, error), ("Reporter::WARNING", "too many connections from <addr>", 5000, 0))
+        self.assertEqual(first, "1500000000.000000 Reporter::WARNING too many connections from 10.0.0.0")
+        self.assertEqual(last_ts - first_ts, 4999 + 3 * doctor.REPORTER_TEMPLATES)
+        self.assertTrue(last.endswith("10.0.19.249"))
+
+class TestWorkerLoad(unittest.TestCase):
+    def test_parse_load_output(self):
+        samples, clock_ticks, cpus, affinity = doctor.parse_load_output(LOAD_OUTPUT)
+        self.assertEqual((clock_ticks, cpus), (100, 4))
+        self.assertEqual(affinity, {"4242": "2", "4243": "0-3"})
+        self.assertEqual(len(samples), 2)
+        first, last = samples
+        self.assertEqual((first["uptime"], last["uptime"]), (1000.0, 1003.0))
+        # Packets, and drops counted with the fifo errors
+        self.assertEqual(first["dev"], {"eth0": (10000, 8), "lo": (2, 0)})
+        self.assertEqual(last["dev"]["eth0"], (20000, 11))
+        self.assertEqual(first["cpu"], {"4242": 600, "4243": 50})
+        self.assertEqual(last["cpu"], {"4242": 900})
+        # Transmit drops are left out
+        self.assertEqual((first["nic"]["eth0"], last["nic"]["eth0"]), (7, 11))
+
+    def test_parse_load_output_failed(self):
+        samples, clock_ticks, cpus, affinity = doctor.parse_load_output(["sh: 1: getconf: not found", "cpus"])
+        self.assertEqual((samples, clock_ticks, cpus, affinity), ([], 100, 1, {}))
+
+    @unittest.skipUnless(doctor.PluginBase.Plugin is doctor.StandalonePlugin and os.path.exists("/proc/self/stat"),
+                         "needs /proc, and to run without broctl")
+    def test_check_worker_load(self):
+        busy = subprocess.Popen([sys.executable, "-c", "while 1: pass"])
+        gone = subprocess.Popen([sys.executable, "-c", ""])
+        gone.wait()
+        spool = tempfile.mkdtemp()
+        sample_seconds = doctor.LOAD_SAMPLE_SECONDS
+        try:
+            doctor.LOAD_SAMPLE_SECONDS = 2
+            d = doctor.Doctor()
+            d.global_options = {"logdir": spool, "spooldir": spool}
+            d.init()
+            d.node_list = [doctor.StandaloneNode("manager", type="manager"),
+                           doctor.StandaloneNode("worker-1", interface="lo", pid=busy.pid),
+                           doctor.StandaloneNode("worker-2", interface="lo", pid=gone.pid)]
+            output = []
+            d.message = d.error = output.append
+            self.assertFalse(d.cmd_custom("doctor", "--no-cache check_worker_load", None).ok)
+        finally:
+            doctor.LOAD_SAMPLE_SECONDS = sample_seconds
+            busy.kill()
+            busy.wait()
+            shutil.rmtree(spool)
+        errors = [line for line in output if line.startswith(doctor.RED)]
+        self.assertTrue([e for e in errors if "worker-1: " in e and "% CPU" in e], output)
+        self.assertTrue([e for e in errors if "worker-2 is not running on localhost" in e], output)
+        self.assertTrue([line for line in output if "localhost lo: " in line], output)
+
+class TestLogIndex(unittest.TestCase):
+    """Which rotated logs a --window reaches back to"""
+
+    logs = {
+        "2020-02-25": ["conn.10:00:00-11:00:00.log.gz"],
+        "2020-03-01": ["conn.22:00:00-23:00:00.log.gz", "conn.23:00:00-00:00:00.log.gz"],
+        "2020-03-02": ["conn.00:00:00-01:00:00.log.gz", "conn.01:00:00-02:00:00.log.gz", "dns.01:00:00-02:00:00.log.gz"],
+        "current": ["conn.log", "dns.log"],
+    }
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        for d, names in self.logs.items():
+            os.mkdir(os.path.join(self.dir, d))
+            for name in names:
+                open(os.path.join(self.dir, d, name), "w").close()
+        doctor.reset_run_state()
+
+    def tearDown(self):
+        doctor.reset_run_state()
+        shutil.rmtree(self.dir)
+
+    def at(self, day, clock):
+        return time.mktime(time.strptime(day + " " + clock, "%Y-%m-%d %H:%M:%S"))
+
+    def test_log_file_interval(self):
+        interval = doctor.log_file_interval
+        self.assertEqual(interval("/logs/2020-03-01/conn.22:00:00-23:00:00.log.gz"),
+                         (self.at("2020-03-01", "22:00:00"), self.at("2020-03-01", "23:00:00")))
+        # Rotated at midnight
+        self.assertEqual(interval("/logs/2020-03-01/conn.23:00:00-00:00:00.log.gz"),
+                         (self.at("2020-03-01", "23:00:00"), self.at("2020-03-02", "00:00:00")))
+        self.assertIsNone(interval("/logs/current/conn.log"))
+        self.assertIsNone(interval("/logs/old/conn.22:00:00-23:00:00.log.gz"))
+
+    def files(self, days=7, since=None):
+        return [os.path.relpath(lf.path, self.dir) for lf in doctor.LogIndex(self.dir).files("conn.*", days, since)]
+
+    def test_files_since(self):
+        self.assertEqual(self.files(since=self.at("2020-03-01", "23:30:00")), [
+            os.path.join("2020-03-01", "conn.23:00:00-00:00:00.log.gz"),
+            os.path.join("2020-03-02", "conn.00:00:00-01:00:00.log.gz"),
+            os.path.join("2020-03-02", "conn.01:00:00-02:00:00.log.gz"),
+            os.path.join("current", "conn.log"),
+        ])
+        # Logs that end just as the window starts still count
+        self.assertEqual(self.files(since=self.at("2020-03-02", "01:00:00"))[0],
+                         os.path.join("2020-03-02", "conn.00:00:00-01:00:00.log.gz"))
+        self.assertEqual(self.files(since=self.at("2020-03-03", "00:00:00")), [os.path.join("current", "conn.log")])
+
+    def test_files_days(self):
+        self.assertEqual(len(self.files()), 6)
+        self.assertEqual(self.files(days=1), [
+            os.path.join("2020-03-02", "conn.00:00:00-01:00:00.log.gz"),
+            os.path.join("2020-03-02", "conn.01:00:00-02:00:00.log.gz"),
+            os.path.join("current", "conn.log"),
+        ])
+
+    def test_listing_cache(self):
+        day = os.path.join(self.dir, "2020-03-02")
+        cached = lambda: doctor.LogIndex(self.dir, cache).files("conn.*", days=1)
+        cache = doctor.ListingCache(os.path.join(self.dir, "listings.sqlite"))
+        self.assertEqual(len(cached()), 3)
+        # A listing stands in for the directory while its mtime is unchanged
+        cache.put(day, os.stat(day).st_mtime, ["conn.05:00:00-06:00:00.log.gz"])
+        cache.close()
+        doctor.reset_run_state()
+        cache = doctor.ListingCache(os.path.join(self.dir, "listings.sqlite"))
+        try:
+            self.assertEqual([os.path.basename(lf.path) for lf in cached()],
+                             ["conn.05:00:00-06:00:00.log.gz", "conn.log"])
+            # current/ is always listed
+            open(os.path.join(self.dir, "current", "conn.1.log"), "w").close()
+            doctor.reset_run_state()
+            self.assertEqual(len(cached()), 3)
+            stat = os.stat(day)
+            os.utime(day, (stat.st_atime, stat.st_mtime + 10))
+            doctor.reset_run_state()
+            self.assertEqual(len(cached()), 4)
+        finally:
+            cache.close()
+
+    def test_window_boundary(self):
+        since = self.at("2020-03-01", "23:30:00")
+        self.assertTrue(doctor.window_boundary(os.path.join(self.dir, "2020-03-01", "conn.23:00:00-00:00:00.log.gz"), since))
+        self.assertFalse(doctor.window_boundary(os.path.join(self.dir, "2020-03-02", "conn.01:00:00-02:00:00.log.gz"), since))
+        self.assertTrue(doctor.window_boundary(os.path.join(self.dir, "current", "conn.log"), since))
+        self.assertFalse(doctor.window_boundary(os.path.join(self.dir, "current", "conn.log"), None))
+
+class TestCollectedPartials(unittest.TestCase):
+    """What print_partials sends back from a logger node loads as the same accumulators"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        write_conn_logs(self.dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def load(self, data):
+        return doctor.PartialsUnpickler(io.BytesIO(zlib.decompress(base64.b64decode(data)))).load()
+
+    def test_round_trip(self):
+        checks = sorted(name for log in doctor.WATCH_LOGS.values() for name in log)
+        script = os.path.join(os.path.dirname(os.path.abspath(doctor.__file__)), "doctor.py")
+        output = subprocess.check_output([sys.executable, script, "partials", self.dir, "--duplicate-sketch", "1"] + checks)
+        lines = output.decode('ascii').split()
+        partials = self.load("".join(lines[lines.index(doctor.PARTIALS_MARK) + 1:]))
+
+        options = doctor.parse_args(["--duplicate-sketch", "1"])[1]
+        expected = doctor.collect_accumulators(self.dir, checks, options, time.time())
+        self.assertEqual(sorted(partials), checks)
+        # Sketch partials carry the tuples they saw
+        sketch = partials["check_duplicate_5_tuples"]
+        self.assertTrue(isinstance(sketch, doctor.DuplicateSketchAccumulator))
+        self.assertEqual(sketch.pending, expected["check_duplicate_5_tuples"].pending)
+        for name, acc in expected.items():
+            self.assertTrue(acc.seen)
+            self.assertEqual((summary(partials[name]), partials[name].seen), (summary(acc), acc.seen), name)
+
+    def test_only_accumulators(self):
+        data = base64.b64encode(zlib.compress(pickle.dumps({"check_reporter": subprocess.Popen}, 2)))
+        self.assertRaises(pickle.UnpicklingError, self.load, data)
+
+class TestLogFollower(unittest.TestCase):
+    """LogFollower reads what is added to a log, across rotations"""
+
+    header = b"".join(ASCII_LOG.splitlines(True)[:7])
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "conn.log")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def row(self, uid):
+        return "1500000000.000001\t{}\t10.0.0.1\tworker-1\t(empty)\tS\n".format(uid).encode('latin-1')
+
+    def write(self, data, mode="ab"):
+        with open(self.path, mode) as f:
+            f.write(data)
+
+    def uids(self, follower):
+        return [rec.uid for rec in follower.poll()]
+
+    def test_rotation(self):
+        self.write(self.header + self.row("C1"), "wb")
+        follower = doctor.LogFollower(self.path, ("uid",))
+        try:
+            self.assertEqual(self.uids(follower), [])
+            # Partly written lines wait for the rest
+            row = self.row("C3")
+            self.write(self.row("C2") + row[:10])
+            self.assertEqual(self.uids(follower), ["C2"])
+            self.write(row[10:])
+            self.assertEqual(self.uids(follower), ["C3"])
+            # The rest of the rotated log comes first
+            self.write(self.row("C4"))
+            os.rename(self.path, os.path.join(self.dir, "conn.rotated.log"))
+            self.write(self.header + self.row("C5"), "wb")
+            self.assertEqual(self.uids(follower), ["C4", "C5"])
+            self.write(self.row("C6"))
+            self.assertEqual(self.uids(follower), ["C6"])
+            # Truncated in place
+            self.write(self.header + self.row("C7"), "wb")
+            self.assertEqual(self.uids(follower), ["C7"])
+            # Removed, and written again later
+            os.remove(self.path)
+            self.assertEqual(self.uids(follower), [])
+            self.assertEqual(self.uids(follower), [])
+            self.write(self.header + self.row("C8"), "wb")
+            self.assertEqual(self.uids(follower), ["C8"])
+        finally:
+            follower.close()
+
+    def test_json(self):
+        self.write(b'{"uid":"C1"}\n', "wb")
+        follower = doctor.LogFollower(self.path, ("uid",))
+        try:
+            self.write(b'{"uid":"C2"}\n{"uid":')
+            self.assertEqual(self.uids(follower), ["C2"])
+            self.write(b'"C3"}\n')
+            self.assertEqual(self.uids(follower), ["C3"])
+        finally:
+            follower.close()
+
+class TestProbeCache(unittest.TestCase):
+    """Probes of the bro binary are reused until the binary changes"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.binary = os.path.join(self.dir, "zeek")
+        self.write_binary("Zeek::AF_Packet - Packet acquisition via AF_Packet (dynamic, version 1.4)")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write_binary(self, plugins):
+        with open(self.binary, "w") as f:
+            f.write("#!/bin/sh\necho '{}'\n".format(plugins))
+        os.chmod(self.binary, 0o755)
+
+    def probe(self):
+        """Return the probes of a fresh Doctor, and how many commands it ran"""
+        d = doctor.Doctor()
+        d.global_options = {doctor.BINARY: self.binary, "logdir": self.dir, "spooldir": self.dir}
+        d.init()
+        d.node_list = [doctor.StandaloneNode("worker-1", interface="eth0")]
+        commands = []
+        execute = d.executeParallel
+        def counted(cmds):
+            commands.extend(cmds)
+            return execute(cmds)
+        d.executeParallel = counted
+        d._open_caches()
+        try:
+            return d._probe_bro(), len(commands)
+        finally:
+            d._close_caches()
+            doctor.reset_run_state()
+
+    def test_invalidation(self):
+        probes, commands = self.probe()
+        self.assertEqual(commands, 2)
+        success, ldd, plugins = probes["localhost"]
+        self.assertTrue(success)
+        self.assertIn("AF_Packet", "".join(plugins))
+        # Only the binary is stat'ed while it is unchanged
+        self.assertEqual(self.probe(), (probes, 1))
+        self.write_binary("Zeek::PF_Ring - Packet acquisition via PF_Ring (dynamic)")
+        probes, commands = self.probe()
+        self.assertEqual(commands, 2)
+        self.assertIn("PF_Ring", "".join(probes["localhost"][2]))
+
+class TestDurations(unittest.TestCase):
+    def test_round_trip(self):
+        for text in "90s", "15m", "90m", "1h", "2d", "1.5s":
+            self.assertEqual(doctor.format_duration(doctor.parse_duration(text)), text)
+        self.assertEqual(doctor.format_duration(doctor.parse_duration("120m")), "2h")
+
+class TestProportionStopping(unittest.TestCase):
+    """ProportionAccumulator stops once its interval settles the verdict"""
+
+    def feed(self, acc, loss_every, count):
+        Record = doctor.record_type(acc.columns)
+        for i in range(count):
+            if acc.done:
+                break
+            missed = "1460" if loss_every and i % loss_every == 0 else "0"
+            acc.feed(Record("tcp", "T", "F", "ShADadFf", missed))
+        return acc
+
+    def test_clear_results_stop_early(self):
+        for loss_every in 0, 10:
+            acc = self.feed(doctor.ConnLossAccumulator(), loss_every, 100 * doctor.PROPORTION_STEP)
+            self.assertTrue(acc.done)
+            self.assertEqual(acc.seen % doctor.PROPORTION_STEP, 0)
+            self.assertTrue(acc.seen <= 10 * doctor.PROPORTION_STEP)
+            low, high = acc.interval()
+            self.assertFalse(low <= acc.threshold <= high)
+
+    def test_borderline_reads_on(self):
+        # Right at the 1% threshold
+        acc = self.feed(doctor.ConnLossAccumulator(), 100, 50 * doctor.PROPORTION_STEP)
+        self.assertFalse(acc.done)
+        self.assertEqual(acc.seen, 50 * doctor.PROPORTION_STEP)
+
+    def test_limit(self):
+        acc = doctor.ConnLossAccumulator()
+        acc.limit = 3 * doctor.PROPORTION_STEP
+        self.feed(acc, 100, 50 * doctor.PROPORTION_STEP)
+        self.assertTrue(acc.done)
+        self.assertEqual(acc.seen, acc.limit)
+
+    def test_window_reads_everything(self):
+        acc = doctor.ConnLossAccumulator()
+        acc.limit = None
+        self.feed(acc, 0, 20 * doctor.PROPORTION_STEP)
+        self.assertFalse(acc.done)
+        self.assertEqual(acc.counts(), (0, 20 * doctor.PROPORTION_STEP))
+
+if __name__ == "__main__":
+    unittest.main()